@@ -0,0 +1,258 @@
+"""Admission control: estimate what a render costs and only run as much at once as the box can take.
+
+Every render is priced before it starts (estimate()): the pixel memory it
+will hold and the CPU time it will take, from its layer count, the layer
+sizes (known from the layer cache, or declared in the request) and the
+output format. Two limits apply:
+
+- Per client (the X-API-Key header when the key is listed in
+  ADMISSION_QUOTAS_FILE, else the caller's address), a token bucket of CPU
+  milliseconds per second; over it, a 429 with Retry-After.
+- For the whole box, the memory and CPU of the renders in progress, split
+  evenly between the server processes; renders that don't fit wait in a
+  first-come, first-served queue for a bounded time, then get a 429 with
+  Retry-After.
+
+A render bigger than the whole budget still runs, but only on its own.
+"""
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import encoder
+import layer_cache
+import metrics
+
+ADMISSION_MAX_MEMORY_MB = float(os.environ.get('ADMISSION_MAX_MEMORY_MB', 1024))  # Pixel memory of renders in progress
+ADMISSION_MAX_CPU_MS = float(os.environ.get('ADMISSION_MAX_CPU_MS', 2000 * (os.cpu_count() or 1)))  # Their CPU work
+# Server processes sharing those box-wide budgets, each getting an equal part (gunicorn.conf.py sets WEB_WORKERS)
+ADMISSION_PROCESSES = max(1, int(os.environ.get('WEB_WORKERS', 1)))
+ADMISSION_QUEUE_MAX = int(os.environ.get('ADMISSION_QUEUE_MAX', 64))  # Renders waiting before new ones get a 429
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 5))  # Longest a render waits to start
+ADMISSION_KEY_HEADER = os.environ.get('ADMISSION_KEY_HEADER', 'X-API-Key')
+ADMISSION_CLIENT_RATE = float(os.environ.get('ADMISSION_CLIENT_RATE', 1000))  # CPU ms per second per client; 0 = unlimited
+ADMISSION_CLIENT_BURST = float(os.environ.get('ADMISSION_CLIENT_BURST', 10000))  # CPU ms a client may use at once
+ADMISSION_QUOTAS_FILE = os.environ.get('ADMISSION_QUOTAS_FILE')  # JSON {api_key: {"rate": ..., "burst": ...}}
+ADMISSION_DEFAULT_LAYER_PIXELS = int(os.environ.get('ADMISSION_DEFAULT_LAYER_PIXELS', 4_000_000))  # Assumed when unknown
+
+# Rough CPU milliseconds per megapixel on one core (see bench/bench_pipeline.py)
+DECODE_MS = 40
+COMPOSITE_MS = 3
+TEXT_MS = 5  # Per text block
+ENCODE_MS = {'jpeg': 10, 'png': 200, 'webp': 150, 'avif': 300, 'gif': 50, 'pdf': 10}
+
+_lock = threading.Condition()
+_queue = deque()  # Tickets of renders waiting to start, oldest first
+_in_flight = {'renders': 0, 'memory': 0.0, 'cpu': 0.0}
+_buckets = {}  # client -> (CPU ms left, when that was worked out)
+_quotas = {}  # api key -> (rate, burst)
+
+stats = {'admitted': 0, 'queued': 0, 'rejected_quota': 0, 'rejected_busy': 0}
+
+
+class Overloaded(Exception):
+    # Answered with a 429 and a Retry-After of retry_after seconds
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Cost:
+    def __init__(self, memory=0.0, cpu=0.0):
+        self.memory = memory  # Bytes of pixel buffers held at the peak
+        self.cpu = cpu  # Milliseconds of CPU
+
+    @classmethod
+    def sequential(cls, costs):
+        # Renders done one after another (pages, batch items): the CPU adds up, the memory peaks at the largest
+        costs = list(costs)
+        return cls(max((cost.memory for cost in costs), default=0.0), sum(cost.cpu for cost in costs))
+
+    def __repr__(self):
+        return f'Cost({self.memory / 1e6:.1f} MB, {self.cpu:.0f} ms)'
+
+
+def _layer_pixels(spec):
+    # (width, height) of a layer: known from the layer cache, declared in the request, or assumed
+    entry = layer_cache.peek(spec['url'])
+    if entry is not None and entry.source_size:
+        return entry.source_size
+    if spec.get('size'):
+        return spec['size']
+    side = math.isqrt(ADMISSION_DEFAULT_LAYER_PIXELS)
+    return side, side
+
+
+def estimate(options):
+    # Cost of rendering one parsed request (see render.parse_request())
+    sizes = [(spec, _layer_pixels(spec)) for spec in options['specs'] if spec['url'].strip()]
+    if not sizes:
+        return Cost()
+    base = sizes[0][1]
+    scale = 1.0
+    if options['target_box']:
+        scale = min(1.0, options['target_box'][0] / base[0], options['target_box'][1] / base[1])
+    canvas = base[0] * base[1] * scale * scale
+    # Layers are decoded near the size they are drawn at; fitted ones are drawn at about the canvas size
+    drawn = [canvas if spec['fit'] != 'none' else size[0] * size[1] * scale * scale for spec, size in sizes]
+
+    if options['format'] == 'auto':
+        encode_ms = sum(ENCODE_MS.get(name, 400) for name in encoder.AUTO_FORMATS)
+    else:
+        encode_ms = ENCODE_MS.get(options['format'], 400)
+    cpu = (sum(drawn) * DECODE_MS + sum(min(pixels, canvas) for pixels in drawn) * COMPOSITE_MS
+           + canvas * encode_ms) / 1e6 + len(options['text_blocks']) * TEXT_MS
+    # The canvas, its encoded copy and every decoded layer, at 4 bytes per pixel
+    memory = 4 * (2 * canvas + sum(drawn))
+    return Cost(memory, cpu)
+
+
+def client_id(headers, remote_addr):
+    # Only keys with a configured quota identify a client; anyone could send a new made-up key with every request
+    key = headers.get(ADMISSION_KEY_HEADER)
+    if key and key in _quotas:
+        return key
+    return remote_addr or 'anonymous'
+
+
+def load_quotas(path=ADMISSION_QUOTAS_FILE):
+    # Per-key rates and bursts that replace the defaults
+    if not path:
+        return
+    try:
+        with open(path) as f:
+            entries = json.load(f)
+        for key, quota in entries.items():
+            _quotas[key] = (float(quota.get('rate', ADMISSION_CLIENT_RATE)),
+                            float(quota.get('burst', ADMISSION_CLIENT_BURST)))
+    except (OSError, ValueError, AttributeError) as e:
+        print(f"Error reading admission quotas file {path}: {e}")
+        return
+    print(f"Loaded {len(_quotas)} admission quotas from {path}")
+
+
+def charge(client, cost):
+    """Take a render's CPU cost from the client's quota, or raise Overloaded.
+
+    A client may run its bucket negative with one render, then waits for it
+    to refill, so a single big render is never refused outright.
+    """
+    rate, burst = _quotas.get(client, (ADMISSION_CLIENT_RATE, ADMISSION_CLIENT_BURST))
+    if rate <= 0:
+        return
+    now = time.monotonic()
+    with _lock:
+        tokens, updated = _buckets.get(client, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        if tokens <= 0:
+            _buckets[client] = (tokens, now)
+            stats['rejected_quota'] += 1
+            metrics.ADMISSION_REJECTED.inc(reason='quota')
+            raise Overloaded('Render quota exceeded; slow down', max(1, math.ceil(-tokens / rate)))
+        _buckets[client] = (tokens - cost.cpu, now)
+        if len(_buckets) > 10000:
+            # Forget clients whose buckets have refilled; they start full anyway
+            for key in [key for key, (left, at) in _buckets.items() if left + (now - at) * rate >= burst]:
+                del _buckets[key]
+
+
+def refund(client, charged, actual):
+    # Give back what a render was overcharged once its real layer sizes are known (estimates assume the worst)
+    rate, burst = _quotas.get(client, (ADMISSION_CLIENT_RATE, ADMISSION_CLIENT_BURST))
+    if rate <= 0 or actual.cpu >= charged.cpu:
+        return
+    with _lock:
+        if client in _buckets:
+            tokens, updated = _buckets[client]
+            _buckets[client] = (min(burst, tokens + charged.cpu - actual.cpu), updated)
+
+
+def _fits(cost):
+    # Called with _lock held; a render always fits when nothing else is running
+    if not _in_flight['renders']:
+        return True
+    return (_in_flight['memory'] + cost.memory <= ADMISSION_MAX_MEMORY_MB * 1024 * 1024 / ADMISSION_PROCESSES
+            and _in_flight['cpu'] + cost.cpu <= ADMISSION_MAX_CPU_MS / ADMISSION_PROCESSES)
+
+
+def _retry_after():
+    # Called with _lock held: about how long until the work in progress and in the queue has drained
+    return max(1, math.ceil(_in_flight['cpu'] / 1000 / max(1, (os.cpu_count() or 1) / ADMISSION_PROCESSES)))
+
+
+def acquire(cost):
+    # Wait (first come, first served) until the render fits in the budget, or raise Overloaded
+    start = time.monotonic()
+    ticket = object()
+    with _lock:
+        if _queue or not _fits(cost):
+            if len(_queue) >= ADMISSION_QUEUE_MAX:
+                stats['rejected_busy'] += 1
+                metrics.ADMISSION_REJECTED.inc(reason='busy')
+                raise Overloaded('Server is busy', _retry_after())
+            stats['queued'] += 1
+        _queue.append(ticket)
+        try:
+            while _queue[0] is not ticket or not _fits(cost):
+                remaining = start + ADMISSION_QUEUE_TIMEOUT - time.monotonic()
+                if remaining <= 0:
+                    stats['rejected_busy'] += 1
+                    metrics.ADMISSION_REJECTED.inc(reason='busy')
+                    raise Overloaded('Server is busy', _retry_after())
+                _lock.wait(remaining)
+            _in_flight['renders'] += 1
+            _in_flight['memory'] += cost.memory
+            _in_flight['cpu'] += cost.cpu
+            stats['admitted'] += 1
+        finally:
+            _queue.remove(ticket)
+            _lock.notify_all()
+    metrics.ADMISSION_WAIT_SECONDS.observe(time.monotonic() - start)
+
+
+def release(cost):
+    with _lock:
+        _in_flight['renders'] -= 1
+        _in_flight['memory'] -= cost.memory
+        _in_flight['cpu'] -= cost.cpu
+        _lock.notify_all()
+
+
+@contextmanager
+def slot(cost):
+    # Hold a share of the budget for the duration of a render
+    acquire(cost)
+    try:
+        yield
+    finally:
+        release(cost)
+
+
+class Streamed:
+    # Hands a streamed response's chunks through and gives its budget back once it is finished or closed
+    def __init__(self, chunks, cost):
+        self._chunks, self._cost, self._released = chunks, cost, False
+
+    def __iter__(self):
+        try:
+            yield from self._chunks
+        finally:
+            self.close()
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            release(self._cost)
+            getattr(self._chunks, 'close', lambda: None)()
+
+
+def get_stats():
+    with _lock:
+        return dict(stats, in_flight=_in_flight['renders'], waiting=len(_queue),
+                    memory_mb=round(_in_flight['memory'] / (1024 * 1024), 1), cpu_ms=round(_in_flight['cpu']),
+                    max_memory_mb=round(ADMISSION_MAX_MEMORY_MB / ADMISSION_PROCESSES, 1),
+                    max_cpu_ms=round(ADMISSION_MAX_CPU_MS / ADMISSION_PROCESSES), processes=ADMISSION_PROCESSES)
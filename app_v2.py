@@ -1,107 +1,316 @@
-from flask import Flask, request, jsonify, send_file
-from PIL import Image, ImageDraw, ImageFont
-import requests
+import json
+import os
+import zipfile
+from functools import partial
 from io import BytesIO
 
+from flask import Flask, Response, request, jsonify, url_for
+
+import admission
+import encoder
+import fetcher
+import font_cache
+import jobs
+import layer_cache
+import metrics
+import output_cache
+import render
+import render_pool
+import singleflight
+import templates
+
+# Largest number of compositions accepted by /combine-images/batch
+MAX_BATCH_ITEMS = int(os.environ.get('MAX_BATCH_ITEMS', 500))
+
 app = Flask(__name__)
 
+# Identical renders that arrive while one is in progress wait for it instead of starting their own
+_renders = singleflight.Group('render')
+
+# Warm the font registry from FONT_PRELOAD_FILE, if one is configured
+font_cache.preload()
+admission.load_quotas()
+
+
 @app.route('/combine-images', methods=['POST'])
 def combine_images():
+    # Time every stage of the request and report it in Server-Timing and on /metrics
+    timings = metrics.start_request()
+    response = app.make_response(_combine_images())
+    if response.is_streamed:
+        metrics.finish_request(timings, response.status_code)
+    else:
+        metrics.finish_request(timings, response.status_code, response.content_length)
+        response.headers['Server-Timing'] = metrics.server_timing(
+            timings, [f'size;desc="{response.content_length} bytes"'])
+    return response
+
+
+def _estimate(data):
+    # What rendering a /combine-images payload will cost; raises RenderError for a bad payload
+    if isinstance(data, dict) and 'pages' in data:
+        _, _, pages = render.parse_pages(data)
+        return admission.Cost.sequential(admission.estimate(options) for options, _ in pages)
+    return admission.estimate(render.parse_request(data))
+
+
+def _client():
+    return admission.client_id(request.headers, request.remote_addr)
+
+
+def _charge(cost):
+    # Take a render's cost from the caller's quota; raises admission.Overloaded when it is used up
+    admission.charge(_client(), cost)
+
+
+def _refund(cost, actual=None):
+    # Give back what a charged render didn't use: the overestimate once it is done, or all of it if it failed
+    admission.refund(_client(), cost, actual or admission.Cost())
+
+
+def _render_admitted(render_fn, data, cost):
+    # Render once there is room in the memory and CPU budget; a streamed output keeps its share until it is encoded
+    admission.acquire(cost)
+    try:
+        body, mime_type = render_fn(data)
+    except Exception:
+        admission.release(cost)
+        raise
+    if isinstance(body, encoder.Stream):
+        body.add_done_callback(lambda _: admission.release(cost))
+    else:
+        admission.release(cost)
+    return body, mime_type
+
+
+def _cache_when_encoded(stream, key, options):
+    # Put a streamed output in the output cache once all of it has been encoded
+    def put(stream):
+        if stream.error is None:
+            output_cache.put(key or output_cache.request_key(options), stream.result(), stream.mime_type)
+    stream.add_done_callback(put)
+
+
+def _combine_images():
     try:
-        # Extract data from the POST request
         data = request.json
-        image_urls = data.get('images', [])  # List of image URLs
-        text_layer = data.get('text', "")  # Text layer content
-        font_url = data.get('font_url', None)  # URL for the font file (e.g., from S3)
-        font_size = data.get('font_size', 180)  # Default font size is 180px
-        text_position = data.get('text_position', (100, 100))  # Default position (x, y)
-        font_value = data.get('font', "No")  # If the font is "No", we will skip the text layer
-
-        if not image_urls:
-            return jsonify({'error': 'No images provided in the request'}), 400
-
-        # Fetch the first image to determine the canvas size
-        base_image = None
-        for url in image_urls:
-            if not url.strip():  # Skip empty or blank URLs
-                continue
-            print(f"Fetching base image from: {url}")
+        if isinstance(data, dict) and data.get('async'):
+            # Queue the render and hand back a job id to poll instead of waiting for it
+            cost = _estimate(data)
+            _charge(cost)
             try:
-                response = requests.get(url, timeout=10)
-                if response.status_code == 200:
-                    base_image = Image.open(BytesIO(response.content)).convert("RGBA")
-                    break  # Exit loop once a valid base image is found
-                else:
-                    print(f"Failed to fetch image: {url}, Status Code: {response.status_code}")
-            except Exception as e:
-                print(f"Error fetching base image from {url}: {e}")
-
-        if not base_image:
-            return jsonify({'error': 'No valid base image found'}), 400
-
-        # Create a white background canvas with the same size as the base image
-        canvas = Image.new("RGBA", base_image.size, color="white")
-        canvas = Image.alpha_composite(canvas, base_image)
-
-        # Overlay each subsequent image
-        for url in image_urls[1:]:
-            if not url.strip():  # Skip empty or blank URLs
-                continue
-            print(f"Fetching overlay image from: {url}")
+                job = jobs.submit(data)
+            except Exception:
+                _refund(cost)  # Rejected (bad payload or full queue), so nothing was rendered
+                raise
+            status_url = url_for('job_status', job_id=job.id)
+            return jsonify(dict(job.describe(), status_url=status_url)), 202, {'Location': status_url}
+
+        if isinstance(data, dict) and 'pages' in data:
+            # Multi-page documents are streamed as each page is finished rather than cached
+            cost = _estimate(data)
+            _charge(cost)
             try:
-                response = requests.get(url, timeout=10)
-                if response.status_code == 200:
-                    overlay_image = Image.open(BytesIO(response.content)).convert("RGBA")
-                    canvas = Image.alpha_composite(canvas, overlay_image)
-                else:
-                    print(f"Failed to fetch overlay image from: {url}, Status Code: {response.status_code}")
-            except Exception as e:
-                print(f"Error fetching overlay image from {url}: {e}")
-
-        # Add text layer if font is provided and is not "No"
-        if font_value != "No" and text_layer:
-            if font_url:
-                # Fetch the font file from the provided URL
-                font_response = requests.get(font_url, timeout=10)
-                if font_response.status_code == 200:
-                    font_bytes = BytesIO(font_response.content)
-                    try:
-                        font = ImageFont.truetype(font_bytes, font_size)
-                    except Exception as e:
-                        return jsonify({'error': f'Failed to load font: {e}'}), 400
-                else:
-                    return jsonify({'error': f'Failed to fetch font from URL: {font_url}'}), 400
-            else:
-                # Default to a built-in font if no font URL is provided
-                font = ImageFont.load_default()
-
-            draw = ImageDraw.Draw(canvas)
-            draw.text(text_position, text_layer, font=font, fill="black")
-
-        # Save the final image
-        output_format = data.get('format', 'png').lower()  # Default to PNG
-        output_path = f"output.{output_format}"
-
-        if output_format == 'jpeg':
-            # Convert to RGB to save as JPEG (JPEG does not support transparency)
-            canvas = canvas.convert("RGB")
-            canvas.save(output_path, 'JPEG')
-        elif output_format == 'pdf':
-            # Save as a single-page PDF
-            canvas.convert("RGB").save(output_path, 'PDF')
+                admission.acquire(cost)
+                try:
+                    chunks, mime_type = render.render_pages(data)
+                except Exception:
+                    admission.release(cost)
+                    raise
+            except Exception:
+                _refund(cost)  # Turned away as busy, or failed before anything was sent
+                raise
+            _refund(cost, _estimate(data))  # Every layer has been fetched by now
+            return Response(admission.Streamed(chunks, cost), mimetype=mime_type)
+
+        # Identical requests over unchanged layers are answered from the output cache
+        options = render.parse_request(data)
+        with metrics.stage('cache'):
+            key = output_cache.request_key(options)
+            cached = output_cache.get(key) if key else None
+        if cached is not None:
+            body, mime_type, etag = cached
         else:
-            # Default to PNG
-            canvas.save(output_path, 'PNG')
+            cost = admission.estimate(options)
+            _charge(cost)
+            # Big outputs start going out as soon as the encoder has written something (not from worker processes)
+            render_fn = render_pool.render_request if render_pool.enabled() else partial(render.render, stream=True)
+            # Only the first of several identical renders takes a share of the budget; they can all read one stream
+            try:
+                body, mime_type = _renders.do(output_cache.render_key(options), _render_admitted, render_fn, data, cost)
+            except Exception:
+                _refund(cost)  # Turned away as busy, or the render failed
+                raise
+            _refund(cost, admission.estimate(options))
+            if isinstance(body, encoder.Stream):
+                # Sent chunked, without an ETag, since neither the length nor the hash is known yet
+                _cache_when_encoded(body, key, options)
+                return Response(body, mimetype=mime_type)
+            # The layers are in the layer cache now, so the key can be worked out if it wasn't before
+            etag = output_cache.put(key or output_cache.request_key(options), body, mime_type)
+
+        if request.if_none_match.contains(etag.strip('"')):
+            output_cache.count_not_modified()
+            return Response(status=304, headers={'ETag': etag})
+        return Response(body, mimetype=mime_type, headers={'ETag': etag})
+    except render.RenderError as e:
+        return jsonify({'error': str(e)}), e.status
+    except (jobs.QueueFull, admission.Overloaded) as e:
+        return jsonify({'error': str(e)}), 429, {'Retry-After': str(e.retry_after)}
+    except Exception as e:
+        print(f"Error: {e}")
+        return jsonify({'error': str(e)}), 500
 
-        print(f"Final image saved as {output_path}")
-        mime_type = 'application/pdf' if output_format == 'pdf' else f'image/{output_format}'
-        return send_file(output_path, mimetype=mime_type)
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    # Status of an async render; ?wait=N long-polls up to N seconds for it to finish
+    job = jobs.get(job_id, wait=request.args.get('wait', 0, type=float))
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    info = job.describe()
+    if job.status == 'done':
+        info['result_url'] = url_for('job_result', job_id=job.id)
+    return jsonify(info)
+
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = jobs.get(job_id, wait=request.args.get('wait', 0, type=float), body=True)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    if job.status == 'failed':
+        return jsonify({'error': job.error}), job.error_status
+    if job.status != 'done':
+        return jsonify(job.describe()), 202
+    return Response(job.body, mimetype=job.mime_type)
+
+
+@app.route('/combine-images/batch', methods=['POST'])
+def combine_images_batch():
+    # Render {"items": [...], "defaults": {...}} and return a zip of the results plus manifest.json
+    try:
+        data = request.json
+        items = data.get('items') if isinstance(data, dict) else None
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'No items provided in the request'}), 400
+        if len(items) > MAX_BATCH_ITEMS:
+            return jsonify({'error': f'A batch may contain at most {MAX_BATCH_ITEMS} items'}), 400
+        defaults = data.get('defaults') or {}
+        if not isinstance(defaults, dict):
+            return jsonify({'error': "'defaults' must be an object"}), 400
+
+        costs = []
+        for item in items:
+            try:
+                costs.append(admission.estimate(render.parse_request(dict(defaults, **item))))
+            except (render.RenderError, TypeError):
+                pass  # Reported in the item's result
+        cost = admission.Cost.sequential(costs)
+        _charge(cost)
+        try:
+            with admission.slot(cost):
+                results = render.render_batch(items, defaults)
+        except Exception:
+            _refund(cost)
+            raise
+
+        # Images are already compressed, so store them in the zip as-is
+        archive = BytesIO()
+        manifest = []
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as zf:
+            for index, result in enumerate(results):
+                entry = {'index': index, 'status': result['status']}
+                if result['status'] == 200:
+                    entry['file'] = f"item-{index:04d}.{encoder.EXTENSIONS[result['mime_type']]}"
+                    zf.writestr(entry['file'], result['body'])
+                else:
+                    entry['error'] = result['error']
+                manifest.append(entry)
+            zf.writestr('manifest.json', json.dumps(manifest, indent=2))
+
+        return Response(archive.getvalue(), mimetype='application/zip',
+                        headers={'Content-Disposition': 'attachment; filename="combined-images.zip"'})
+    except admission.Overloaded as e:
+        return jsonify({'error': str(e)}), 429, {'Retry-After': str(e.retry_after)}
     except Exception as e:
         print(f"Error: {e}")
         return jsonify({'error': str(e)}), 500
 
 
-# Run the server on 0.0.0.0 to ensure external access
+@app.route('/templates', methods=['GET'])
+def list_templates():
+    return jsonify({'templates': templates.list_ids()})
+
+
+@app.route('/templates/<template_id>', methods=['PUT'])
+def put_template(template_id):
+    # Register a template, then fetch its layers and precomposite its static part
+    template = request.get_json(silent=True)
+    try:
+        templates.validate(template_id, template)
+        render.parse_request(template)  # A template must be a valid request on its own
+    except templates.TemplateError as e:
+        return jsonify({'error': str(e)}), 400
+    except render.RenderError as e:
+        return jsonify({'error': str(e)}), e.status
+    templates.register(template_id, template)
+    try:
+        return jsonify(render.prepare_template(template_id)), 201
+    except render.RenderError as e:
+        # Kept anyway: the layers may be reachable by the time it is used
+        return jsonify({'template_id': template_id, 'warning': str(e)}), 201
+
+
+@app.route('/templates/<template_id>', methods=['GET'])
+def get_template(template_id):
+    template = templates.get(template_id)
+    if template is None:
+        return jsonify({'error': 'Unknown template'}), 404
+    return jsonify(template)
+
+
+@app.route('/templates/<template_id>', methods=['DELETE'])
+def delete_template(template_id):
+    if not templates.remove(template_id):
+        return jsonify({'error': 'Unknown template'}), 404
+    return Response(status=204)
+
+
+@app.route('/template-cache/stats', methods=['GET'])
+def template_stats():
+    # Hits and size of the precomposited template canvases
+    return jsonify(templates.get_stats())
+
+
+@app.route('/layer-cache/stats', methods=['GET'])
+def layer_cache_stats():
+    # Hit/miss/eviction counters for sizing the layer cache
+    return jsonify(layer_cache.get_stats())
+
+
+@app.route('/output-cache/stats', methods=['GET'])
+def output_cache_stats():
+    # Hit/miss/304 counters for the rendered-output cache
+    return jsonify(output_cache.get_stats())
+
+
+@app.route('/admission/stats', methods=['GET'])
+def admission_stats():
+    # Renders in progress and waiting, their share of the budget, and how many were turned away
+    return jsonify(admission.get_stats())
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    # Prometheus scrape target: stage timings, fetch failures, skipped layers and cache statistics
+    gauges = {'layer_cache': layer_cache.get_stats(), 'output_cache': output_cache.get_stats(),
+              'templates': templates.get_stats(), 'admission': admission.get_stats(),
+              'fetcher': {'open_circuits': fetcher.open_circuits()}}
+    return Response(metrics.exposition(gauges), mimetype='text/plain; version=0.0.4')
+
+
+# Development server only; run `gunicorn app_v2:app` in production (see gunicorn.conf.py)
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0')
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1', host='0.0.0.0', port=int(os.environ.get('PORT', 5000)),
+            threaded=True)
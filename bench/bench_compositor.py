@@ -0,0 +1,111 @@
+"""Compare repeated Image.alpha_composite with the single-pass compositor,
+without and with the per-layer coverage the layer cache keeps.
+
+Each method runs in its own subprocess so peak memory can be measured in
+isolation. Usage:
+
+    python bench/bench_compositor.py --layers 10 --size 4000
+"""
+import argparse
+import gc
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import PeakRSS, release_free_memory  # noqa: E402
+
+
+def _make_layers(count, size, worst_case=False, seed=0):
+    # An opaque base followed by overlays that are transparent except for one band of rows,
+    # like frames and badges; worst_case makes every overlay pixel partially transparent
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    layers = []
+    for index in range(count):
+        pixels = rng.integers(0, 256, (size, size, 4), dtype=np.uint8)
+        if index == 0:
+            pixels[..., 3] = 255
+        elif not worst_case:
+            band = size // count
+            mask = np.ones(size, dtype=bool)
+            mask[index * band:(index + 1) * band] = False
+            pixels[mask, :, 3] = 0
+        layers.append(Image.frombytes("RGBA", (size, size), pixels.tobytes()))
+        del pixels
+    return layers
+
+
+def run_method(method, count, size, worst_case):
+    import numpy as np
+    from PIL import Image
+
+    import compositor
+
+    layers = _make_layers(count, size, worst_case)
+    if method != 'alpha_composite':
+        # The layer cache keeps decoded pixels as arrays, so conversion isn't part of a request
+        layers = [np.array(layer) for layer in layers]
+    if method == 'coverage':
+        # ...and measures each layer's coverage once, when it is first used
+        layers = [(pixels, (0, 0), compositor.Coverage.of(pixels)) for pixels in layers]
+    gc.collect()
+    release_free_memory()
+    peak = PeakRSS()
+
+    start = time.perf_counter()
+    if method == 'alpha_composite':
+        canvas = Image.new("RGBA", (size, size), color="white")
+        for layer in layers:
+            canvas = Image.alpha_composite(canvas, layer)
+    else:
+        canvas = compositor.composite(layers, (size, size))
+    elapsed = time.perf_counter() - start
+
+    return {'method': method, 'seconds': elapsed, 'peak_extra_mb': peak.stop(),
+            'checksum': hashlib.sha256(canvas.tobytes()).hexdigest()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--layers', type=int, default=10)
+    parser.add_argument('--size', type=int, default=2000, help='Width and height of every layer in pixels')
+    parser.add_argument('--worst-case', action='store_true', help='Make every overlay pixel partially transparent')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_method(args.child, args.layers, args.size, args.worst_case)))
+        return
+
+    results = []
+    for method in ('alpha_composite', 'compositor', 'coverage'):
+        command = [sys.executable, __file__, '--child', method, '--layers', str(args.layers), '--size', str(args.size)]
+        if args.worst_case:
+            command.append('--worst-case')
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    # alpha_composite allocates a new canvas per call (plus the white one); the compositor allocates one
+    canvas_mb = args.size * args.size * 4 / (1024 * 1024)
+    allocated = {'alpha_composite': (args.layers + 1) * canvas_mb, 'compositor': canvas_mb, 'coverage': canvas_mb}
+
+    print(f"{args.layers} layers of {args.size}x{args.size}")
+    for result in results:
+        print(f"  {result['method']:<16} {result['seconds'] * 1000:8.1f} ms   peak +{result['peak_extra_mb']:7.1f} MB"
+              f"   canvas buffers allocated {allocated[result['method']]:7.1f} MB")
+    for result in results[1:]:
+        if result['checksum'] != results[0]['checksum']:
+            print(f"  OUTPUT MISMATCH: {result['method']} result differs from alpha_composite")
+            sys.exit(1)
+    print("  outputs are identical")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""Benchmark the whole /combine-images pipeline over a matrix of scenarios.
+
+Layers are generated and served by a local HTTP server (a JPEG base and PNG
+overlays, with optional added latency), and requests go through the Flask
+app in-process, so fetch, decode, composite, text and encode are all
+included. Every scenario runs in its own subprocess so peak memory is
+measured in isolation. Cache modes:
+
+    cold  every request starts with empty layer and output caches
+    warm  layers are cached, the output cache is emptied before each request
+    hit   identical requests answered from the output cache
+
+Save a baseline, then compare later runs against it to catch regressions:
+
+    python bench/bench_pipeline.py --save bench/baselines/pipeline.json
+    python bench/bench_pipeline.py --compare bench/baselines/pipeline.json
+
+Baselines are only comparable on the same machine.
+"""
+import argparse
+import gc
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import PeakRSS, make_layer, percentile, release_free_memory, start_origin  # noqa: E402
+
+
+def _csv(cast):
+    return lambda value: [cast(item) for item in value.split(',') if item]
+
+
+def run_scenario(scenario, iterations, latency, font_path):
+    # Runs in a child process: serve the layers, render `iterations` times and measure
+    for name in ('LAYER_CACHE_DIR', 'OUTPUT_CACHE_DIR'):
+        os.environ.pop(name, None)  # Only the memory tiers, so "cold" really is cold
+    import app_v2
+    import layer_cache
+    import output_cache
+
+    size = (scenario['size'], scenario['size'] * 3 // 4)
+    assets = {'/layer-0.jpg': make_layer(0, size, 'JPEG')}
+    assets.update({f'/layer-{index}.png': make_layer(index, size) for index in range(1, scenario['layers'])})
+    payload = {'images': [f'/layer-{index}.{"jpg" if index == 0 else "png"}' for index in range(scenario['layers'])],
+               'format': scenario['format']}
+    if scenario['text']:
+        payload.update({'text': 'Benchmark', 'font': 'Yes', 'font_size': max(12, scenario['size'] // 20),
+                        'text_position': (size[0] // 10, size[1] // 10)})
+        if font_path:
+            with open(font_path, 'rb') as f:
+                assets['/font.ttf'] = f.read()
+            payload['font_url'] = '/font.ttf'
+
+    origin, base_url = start_origin(assets, latency)
+    payload['images'] = [base_url + path for path in payload['images']]
+    if 'font_url' in payload:
+        payload['font_url'] = base_url + payload['font_url']
+    client = app_v2.app.test_client()
+
+    def request():
+        response = client.post('/combine-images', json=payload)
+        if response.status_code != 200:
+            raise RuntimeError(f'{response.status_code}: {response.get_data(as_text=True)}')
+        return len(response.data)
+
+    out_bytes = request()  # Warm-up: imports, font parsing and, for warm and hit, the caches
+    gc.collect()
+    release_free_memory()
+    peak = PeakRSS()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        if scenario['cache'] == 'cold':
+            layer_cache.clear()
+        if scenario['cache'] != 'hit':
+            output_cache.clear()
+        start = time.perf_counter()
+        request()
+        latencies.append(time.perf_counter() - start)
+    elapsed = time.perf_counter() - started
+    origin.shutdown()
+
+    return dict(scenario, **{
+        'requests': iterations,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p90_ms': round(percentile(latencies, 0.90) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'rps': round(iterations / elapsed, 2),
+        'peak_extra_mb': round(peak.stop(), 1),
+        'peak_rss_mb': round(peak.peak, 1),
+        'out_bytes': out_bytes,
+    })
+
+
+def scenario_key(scenario):
+    return f"{scenario['layers']}L {scenario['size']}px {scenario['format']} " \
+           f"text={'on' if scenario['text'] else 'off'} {scenario['cache']}"
+
+
+def compare(results, baseline, tolerance):
+    # Returns the list of regressions: p50 latency or peak memory more than `tolerance` above the baseline
+    previous = {scenario_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get(scenario_key(result))
+        if before is None:
+            continue
+        for metric in ('p50_ms', 'peak_extra_mb'):
+            # Small absolute differences are noise, whatever the ratio
+            floor = 1.0 if metric == 'p50_ms' else 5.0
+            if result[metric] > before[metric] * (1 + tolerance) and result[metric] - before[metric] > floor:
+                regressions.append(f"{scenario_key(result)}: {metric} {before[metric]} -> {result[metric]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--layers', type=_csv(int), default=[2, 5], help='comma-separated layer counts')
+    parser.add_argument('--sizes', type=_csv(int), default=[800, 2000], help='comma-separated canvas widths')
+    parser.add_argument('--formats', type=_csv(str), default=['png', 'jpeg'], help='comma-separated output formats')
+    parser.add_argument('--text', type=_csv(str), default=['off', 'on'], help='off, on or both')
+    parser.add_argument('--cache', type=_csv(str), default=['cold', 'warm', 'hit'], help='cold, warm and/or hit')
+    parser.add_argument('--iterations', type=int, default=20, help='measured requests per scenario')
+    parser.add_argument('--latency', type=float, default=0, help='ms added to each download from the origin')
+    parser.add_argument('--font', help='TrueType file to draw the text with (default: the built-in bitmap font)')
+    parser.add_argument('--save', help='write the results to this JSON file as a baseline')
+    parser.add_argument('--compare', help='baseline JSON file to compare against; exits 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown or growth, as a fraction')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_scenario(json.loads(args.child), args.iterations, args.latency / 1000, args.font)))
+        return
+
+    results = []
+    print(f"{'scenario':<36}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'req/s':>9}{'peak +MB':>10}{'out KB':>9}")
+    for layers, size, output_format, text, cache in itertools.product(
+            args.layers, args.sizes, args.formats, args.text, args.cache):
+        scenario = {'layers': layers, 'size': size, 'format': output_format, 'text': text == 'on', 'cache': cache}
+        command = [sys.executable, __file__, '--child', json.dumps(scenario),
+                   '--iterations', str(args.iterations), '--latency', str(args.latency)]
+        if args.font:
+            command += ['--font', args.font]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        print(f"{scenario_key(result):<36}{result['p50_ms']:>10}{result['p90_ms']:>10}{result['p99_ms']:>10}"
+              f"{result['rps']:>9}{result['peak_extra_mb']:>10}{result['out_bytes'] // 1024:>9}")
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'iterations': args.iterations,
+                       'latency_ms': args.latency, 'results': results}, f, indent=2)
+        print(f"Saved baseline to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {args.tolerance:.0%}:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"No regressions over {args.tolerance:.0%} against {args.compare}")
+
+
+if __name__ == '__main__':
+    main()
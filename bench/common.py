@@ -0,0 +1,111 @@
+"""Helpers shared by the benchmark scripts: memory sampling, percentiles and a
+local stand-in for the image origin (S3), so results only depend on this machine."""
+import ctypes
+import io
+import resource
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class PeakRSS:
+    # Samples resident memory in a background thread while the measured code runs
+    def __init__(self):
+        self.peak = self.start = current_rss_mb()
+        self._running = True
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def _sample(self):
+        while self._running:
+            self.peak = max(self.peak, current_rss_mb())
+            time.sleep(0.001)
+
+    def stop(self):
+        # Stop sampling; returns how far above the starting RSS memory went, in MB
+        self._running = False
+        self._thread.join()
+        self.peak = max(self.peak, current_rss_mb())
+        return self.peak - self.start
+
+
+def current_rss_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def release_free_memory():
+    # Hand freed heap pages back to the OS so they don't hide the measured allocations
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except OSError:
+        pass
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else float('nan')
+
+
+def make_layer(index, size, image_format='PNG', seed=0):
+    """Encode one synthetic layer of size (width, height).
+
+    Layer 0 is an opaque photo-like base; later layers are mostly transparent
+    artwork (a band of shapes), like frames and badges. Content is smooth with
+    some noise so files compress like real images rather than like pure noise.
+    """
+    import numpy as np
+    from PIL import Image
+
+    width, height = size
+    rng = np.random.default_rng(seed + index)
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = np.empty((height, width, 4), dtype=np.uint8)
+    pixels[..., 0] = (x * 255 // max(width - 1, 1) + index * 40) % 256
+    pixels[..., 1] = (y * 255 // max(height - 1, 1) + index * 70) % 256
+    pixels[..., 2] = ((x + y) * 127 // max(width + height - 2, 1) + index * 90) % 256
+    pixels[..., :3] += rng.integers(0, 16, (height, width, 3), dtype=np.uint8)
+    if index == 0:
+        pixels[..., 3] = 255
+    else:
+        band = (y * 8 // max(height, 1)) == (index % 8)
+        pixels[..., 3] = np.where(band, np.where((x // 16 + y // 16) % 2 == 0, 255, 128), 0)
+
+    image = Image.fromarray(pixels, 'RGBA')
+    if image_format.upper() == 'JPEG':
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, image_format.upper(), **({'quality': 90} if image_format.upper() == 'JPEG' else {'compress_level': 1}))
+    return buffer.getvalue()
+
+
+def start_origin(assets, latency=0.0):
+    # Serve {path: bytes} over HTTP from a background thread, waiting `latency` seconds before
+    # each response; returns (server, base URL)
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            time.sleep(latency)
+            body = assets.get(self.path)
+            if body is None:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Cache-Control', 'max-age=3600')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
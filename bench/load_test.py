@@ -0,0 +1,149 @@
+"""Load-test /combine-images under the development server and under gunicorn.
+
+Layers come from a local stand-in image server (with optional added latency,
+to mimic S3), so results only depend on this machine. Each server runs in its
+own subprocess and is driven by a pool of client threads for a fixed time.
+Usage:
+
+    python bench/load_test.py --server both --concurrency 32 --duration 20
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+from common import make_layer, percentile, start_origin
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _make_assets(layers, size):
+    return {f'/layer-{index}.png': make_layer(index, (size, size)) for index in range(layers)}
+
+
+def start_server(kind, port, workers, threads):
+    env = dict(os.environ, PORT=str(port), HOST='127.0.0.1', WEB_WORKERS=str(workers),
+               WEB_THREADS=str(threads), WEB_ACCESS_LOG='', PYTHONUNBUFFERED='1')
+    if kind == 'dev':
+        command = [sys.executable, 'app_v2.py']
+    else:
+        command = [sys.executable, '-m', 'gunicorn', 'app_v2:app']
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    # Wait until the server answers
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.get(f'http://127.0.0.1:{port}/layer-cache/stats', timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f'{kind} server did not start on port {port}')
+
+
+def stop_server(process):
+    # SIGTERM is what a process manager sends; gunicorn drains in-flight requests before exiting
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def run_load(url, payload, concurrency, duration, unique):
+    # Hammer the endpoint from `concurrency` threads; returns (latencies in seconds, error count, elapsed)
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    counter = iter(range(10 ** 9))
+    stop_at = time.perf_counter() + duration
+
+    def client():
+        session = requests.Session()
+        while time.perf_counter() < stop_at:
+            body = payload
+            if unique:
+                # Vary the text so every request really renders instead of hitting the output cache
+                with lock:
+                    body = dict(payload, text=f'#{next(counter)}')
+            start = time.perf_counter()
+            try:
+                ok = session.post(url, json=body, timeout=60).status_code == 200
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+
+    started = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return latencies, errors[0], time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', choices=('dev', 'gunicorn', 'both'), default='both')
+    parser.add_argument('--concurrency', type=int, default=16, help='client threads')
+    parser.add_argument('--duration', type=float, default=15, help='seconds of load per server')
+    parser.add_argument('--warmup', type=float, default=2, help='seconds of load before measuring')
+    parser.add_argument('--layers', type=int, default=3)
+    parser.add_argument('--size', type=int, default=800, help='layer width and height in pixels')
+    parser.add_argument('--origin-latency', type=float, default=50, help='ms added to each image download')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2, help='gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=8, help='gunicorn threads per worker')
+    parser.add_argument('--repeat', action='store_true', help='send identical requests (output cache hits)')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    origin, base_url = start_origin(_make_assets(args.layers, args.size), args.origin_latency / 1000)
+    payload = {'images': [f'{base_url}/layer-{index}.png' for index in range(args.layers)],
+               'text': 'load test', 'font': 'Yes', 'font_size': 40, 'format': 'jpeg'}
+
+    results = []
+    for kind in (('dev', 'gunicorn') if args.server == 'both' else (args.server,)):
+        process = start_server(kind, args.port, args.workers, args.threads)
+        url = f'http://127.0.0.1:{args.port}/combine-images'
+        try:
+            run_load(url, payload, args.concurrency, args.warmup, not args.repeat)
+            latencies, errors, elapsed = run_load(url, payload, args.concurrency, args.duration, not args.repeat)
+        finally:
+            stop_server(process)
+        results.append({
+            'server': kind,
+            'requests': len(latencies),
+            'errors': errors,
+            'rps': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+            'p90_ms': round(percentile(latencies, 0.90) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+            'max_ms': round(max(latencies, default=float('nan')) * 1000, 1),
+        })
+    origin.shutdown()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{args.layers} layers of {args.size}px, {args.concurrency} clients, "
+          f"{args.origin_latency:g}ms origin latency, {'repeated' if args.repeat else 'unique'} requests")
+    print(f"{'server':<10}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for r in results:
+        print(f"{r['server']:<10}{r['requests']:>10}{r['errors']:>8}{r['rps']:>10}{r['p50_ms']:>10}"
+              f"{r['p90_ms']:>10}{r['p99_ms']:>10}{r['max_ms']:>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+import numpy as np
+from PIL import Image
+
+# Rows blended at a time; keeps the scratch buffers small enough to stay in CPU cache
+ROWS_PER_STRIP = 32
+
+# Fixed-point precision used by Pillow's alpha_composite (libImaging/AlphaComposite.c)
+PRECISION_BITS = 7
+
+
+# How a layer is lined up against the canvas before its offset is applied
+ANCHORS = {
+    'top-left': (0.0, 0.0), 'top': (0.5, 0.0), 'top-right': (1.0, 0.0),
+    'left': (0.0, 0.5), 'center': (0.5, 0.5), 'right': (1.0, 0.5),
+    'bottom-left': (0.0, 1.0), 'bottom': (0.5, 1.0), 'bottom-right': (1.0, 1.0),
+}
+FITS = ('none', 'contain', 'cover', 'stretch')
+
+
+class _Scratch:
+    # Preallocated work buffers for one strip, reused for every layer.
+    # Buffers are flat so any smaller region can get a contiguous view of them.
+    def __init__(self, rows, width):
+        pixels = rows * width
+        self.src_a = np.empty(pixels, dtype=np.uint32)
+        self.blend = np.empty(pixels, dtype=np.uint32)
+        self.outa255 = np.empty(pixels, dtype=np.uint32)
+        self.coef1 = np.empty(pixels, dtype=np.uint32)
+        self.coef2 = np.empty(pixels, dtype=np.uint32)
+        self.tmp = np.empty(pixels, dtype=np.uint32)
+        self.tmp2 = np.empty(pixels, dtype=np.uint32)
+        self.visible = np.empty(pixels, dtype=bool)
+        # Buffers for the opaque-canvas path, which works on all four channels at once
+        self.alpha32 = np.empty(pixels, dtype=np.uint32)
+        self.inverse_alpha = np.empty(pixels * 4, dtype=np.uint8)
+        self.wide = np.empty(pixels * 4, dtype=np.uint16)
+        self.wide_b = np.empty(pixels * 4, dtype=np.uint16)
+
+    def view(self, rows, cols):
+        # Contiguous views of the buffers shaped for a rows x cols region
+        shaped = _Scratch.__new__(_Scratch)
+        for name, buffer in vars(self).items():
+            lanes = buffer.size // self.src_a.size
+            shape = (rows, cols, lanes) if lanes > 1 else (rows, cols)
+            setattr(shaped, name, buffer[:rows * cols * lanes].reshape(shape))
+        return shaped
+
+
+class Coverage:
+    """Which parts of a layer have any ink, worked out once per decoded layer.
+
+    Pass it as the third item of a layer, (pixels, (x, y), coverage), and
+    composite() copies opaque rows straight onto the canvas, skips
+    transparent ones and only blends the columns that have ink, without
+    looking at the pixels again. Results are identical either way.
+    """
+    __slots__ = ('row_min', 'row_max', 'left', 'right')
+
+    def __init__(self, row_min, row_max, left, right):
+        self.row_min = row_min  # Lowest alpha in each row
+        self.row_max = row_max  # Highest alpha in each row
+        self.left, self.right = left, right  # Columns [left, right) hold every non-transparent pixel
+
+    @classmethod
+    def of(cls, pixels):
+        # Measure a (height, width, 4) RGBA array
+        alpha = np.asarray(pixels)[..., 3]
+        columns = np.flatnonzero(alpha.max(axis=0))
+        left, right = (int(columns[0]), int(columns[-1]) + 1) if columns.size else (0, 0)
+        return cls(alpha.min(axis=1), alpha.max(axis=1), left, right)
+
+    @classmethod
+    def solid(cls, shape):
+        # Coverage of a fully opaque array of the given shape, e.g. a canvas composited over an opaque background
+        height, width = shape[:2]
+        full = np.full(height, 255, dtype=np.uint8)
+        return cls(full, full, 0, width)
+
+    @property
+    def opaque(self):
+        return bool(self.row_min.size) and self.left == 0 and int(self.row_min.min()) == 255
+
+    @property
+    def empty(self):
+        return self.left == self.right
+
+
+def _blend_onto_opaque(dst, src, s):
+    # Blend src over a fully opaque dst in place.
+    #
+    # With dst_a == 255, alpha_composite's output alpha is always 255 and its
+    # colour math reduces exactly to round(t / 255) for t = src * a + dst * (255 - a),
+    # which fits in uint16 (checked against Pillow for every src, dst and alpha).
+    rows, width = s.alpha32.shape
+
+    # Pull alpha out of each little-endian RGBA word, then copy it into all four bytes
+    np.right_shift(src.view('<u4')[..., 0], 24, out=s.alpha32)
+    if not s.alpha32.any():
+        return  # Strip is fully transparent
+    if s.alpha32.min() == 255:
+        np.copyto(dst, src)  # Strip is fully opaque
+        return
+    np.multiply(s.alpha32, 0x01010101, out=s.alpha32)
+    alpha = s.alpha32.view(np.uint8).reshape(rows, width, 4)
+    np.invert(alpha, out=s.inverse_alpha)  # 255 - a
+
+    np.multiply(src, alpha, out=s.wide, dtype=np.uint16)
+    np.multiply(dst, s.inverse_alpha, out=s.wide_b, dtype=np.uint16)
+    np.add(s.wide, s.wide_b, out=s.wide)
+
+    # Rounded divide by 255: (t + 128 + ((t + 128) >> 8)) >> 8
+    np.add(s.wide, 128, out=s.wide)
+    np.right_shift(s.wide, 8, out=s.wide_b)
+    np.add(s.wide, s.wide_b, out=s.wide)
+    np.right_shift(s.wide, 8, out=s.wide)
+    np.copyto(dst, s.wide, casting='unsafe')
+    dst[..., 3] = 255  # The alpha lane above was scratch; the canvas stays opaque
+
+
+def _blend_into(dst, src, s):
+    # Blend src over dst in place with the exact integer math of Image.alpha_composite
+    np.copyto(s.src_a, src[..., 3])
+    np.greater(s.src_a, 0, out=s.visible)  # Fully transparent source pixels leave dst untouched
+
+    # blend = dst_a * (255 - src_a); outa255 = src_a * 255 + blend
+    np.subtract(255, s.src_a, out=s.blend)
+    np.multiply(s.blend, dst[..., 3], out=s.blend)
+    np.multiply(s.src_a, 255, out=s.outa255)
+    np.add(s.outa255, s.blend, out=s.outa255)
+
+    # coef1 = src_a * 255 * 255 * 2^7 / outa255; coef2 = 255 * 2^7 - coef1
+    np.multiply(s.src_a, 255 * 255 << PRECISION_BITS, out=s.coef1)
+    np.maximum(s.outa255, 1, out=s.tmp)  # Avoid 0/0 where both pixels are transparent (masked below)
+    np.floor_divide(s.coef1, s.tmp, out=s.coef1)
+    np.subtract(255 << PRECISION_BITS, s.coef1, out=s.coef2)
+
+    for channel in range(3):
+        # out = DIV255(src * coef1 + dst * coef2 + (0x80 << 7)) >> 7
+        np.multiply(s.coef1, src[..., channel], out=s.tmp)
+        np.multiply(s.coef2, dst[..., channel], out=s.tmp2)
+        np.add(s.tmp, s.tmp2, out=s.tmp)
+        np.add(s.tmp, 0x80 << PRECISION_BITS, out=s.tmp)
+        np.right_shift(s.tmp, 8, out=s.tmp2)
+        np.add(s.tmp, s.tmp2, out=s.tmp)
+        np.right_shift(s.tmp, 8 + PRECISION_BITS, out=s.tmp)
+        np.copyto(dst[..., channel], s.tmp, where=s.visible, casting='unsafe')
+
+    # out_a = DIV255(outa255 + 0x80)
+    np.add(s.outa255, 0x80, out=s.outa255)
+    np.right_shift(s.outa255, 8, out=s.tmp)
+    np.add(s.outa255, s.tmp, out=s.outa255)
+    np.right_shift(s.outa255, 8, out=s.outa255)
+    np.copyto(dst[..., 3], s.outa255, where=s.visible, casting='unsafe')
+
+
+def fitted_size(size, canvas_size, fit='none'):
+    # The (width, height) a layer of the given size should be drawn at for a fit mode
+    if fit not in FITS:
+        raise ValueError(f"Unknown fit '{fit}', expected one of {', '.join(FITS)}")
+    if fit == 'none':
+        return tuple(size)
+    if fit == 'stretch':
+        return tuple(canvas_size)
+    pick = min if fit == 'contain' else max
+    scale = pick(canvas_size[0] / size[0], canvas_size[1] / size[1])
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def position(size, canvas_size, anchor='top-left', offset=(0, 0)):
+    """Work out where a layer of the given (width, height) goes on the canvas.
+
+    The anchor lines the layer up with the same point of the canvas (e.g.
+    'center' centres it, 'bottom-right' puts it in the corner) and the offset
+    then moves it by that many pixels. Returns the (x, y) of its top-left corner.
+    """
+    if anchor not in ANCHORS:
+        raise ValueError(f"Unknown anchor '{anchor}', expected one of {', '.join(ANCHORS)}")
+    fx, fy = ANCHORS[anchor]
+    x = round((canvas_size[0] - size[0]) * fx) + int(offset[0])
+    y = round((canvas_size[1] - size[1]) * fy) + int(offset[1])
+    return x, y
+
+
+def _unpack(layer):
+    # (pixels, (x, y), coverage or None) from any of the layer forms composite() accepts
+    if not isinstance(layer, tuple):
+        return layer, (0, 0), None
+    if len(layer) == 2:
+        return layer[0], layer[1], None
+    return layer
+
+
+def place(pixels, canvas_size, anchor='top-left', offset=(0, 0)):
+    # (pixels, (x, y)) ready to pass to composite(); use fitted_size() first to scale the layer
+    height, width = pixels.shape[:2]
+    return pixels, position((width, height), canvas_size, anchor, offset)
+
+
+def composite(layers, size, background=(255, 255, 255, 255), start=None):
+    """Blend RGBA layers (bottom first) over a solid background in a single pass.
+
+    Each layer is an RGBA Image or (height, width, 4) uint8 array drawn at the
+    top-left corner, or a (pixels, (x, y)) pair from place(). Layers may be any
+    size; only the part that overlaps the canvas is touched, so a small sticker
+    costs its own area rather than the whole canvas.
+
+    The result is identical to starting from Image.new("RGBA", size, background)
+    and calling Image.alpha_composite once per layer (with each layer padded to
+    the canvas size), but only one full-size buffer is ever allocated: the
+    canvas is processed in strips of rows and every layer is blended into each
+    strip before moving on.
+
+    start, if given, is the pixel array of an earlier composite() over the same
+    background; the layers are blended on top of a copy of it.
+
+    A layer may also be (pixels, (x, y), Coverage) to let opaque and empty
+    rows skip the blend; see Coverage.
+    """
+    return Image.fromarray(composite_pixels(layers, size, background, start), "RGBA")
+
+
+def composite_pixels(layers, size, background=(255, 255, 255, 255), start=None):
+    # composite(), returning the (height, width, 4) uint8 array instead of an Image
+    width, height = size
+    canvas = np.empty((height, width, 4), dtype=np.uint8)
+    canvas_words = canvas.view('<u4').reshape(height, width)
+    background_word = np.frombuffer(bytes(background), dtype='<u4')[0]
+
+    placed = []
+    for layer in layers:
+        pixels, (x, y), coverage = _unpack(layer)
+        pixels = np.asarray(pixels)
+        ink_left, ink_right = (coverage.left, coverage.right) if coverage else (0, pixels.shape[1])
+        # Clip the layer (or just its inked columns) to the canvas once, up front
+        left, right = max(x + ink_left, 0), min(x + ink_right, width)
+        upper, lower = max(y, 0), min(y + pixels.shape[0], height)
+        if left < right and upper < lower:
+            placed.append((pixels, x, y, left, right, upper, lower, coverage))
+
+    # An opaque background keeps the canvas opaque, which allows the cheaper blend
+    blend = _blend_onto_opaque if background[3] == 255 else _blend_into
+
+    scratch = _Scratch(min(ROWS_PER_STRIP, height), width)
+    for top in range(0, height, ROWS_PER_STRIP):
+        bottom = min(top + ROWS_PER_STRIP, height)
+        # Fill the background (or copy the starting canvas) while the strip is in cache
+        if start is None:
+            canvas_words[top:bottom] = background_word
+        else:
+            canvas[top:bottom] = start[top:bottom]
+        for pixels, x, y, left, right, upper, lower, coverage in placed:
+            rows_from, rows_to = max(top, upper), min(bottom, lower)
+            if rows_from >= rows_to:
+                continue  # Layer doesn't reach this strip
+            dst = canvas[rows_from:rows_to, left:right]
+            src = pixels[rows_from - y:rows_to - y, left - x:right - x]
+            if coverage is not None:
+                if not coverage.row_max[rows_from - y:rows_to - y].any():
+                    continue  # Nothing but transparent pixels in these rows
+                if coverage.row_min[rows_from - y:rows_to - y].min() == 255:
+                    np.copyto(dst, src)  # Opaque rows simply replace what is under them
+                    continue
+            blend(dst, src, scratch.view(rows_to - rows_from, right - left))
+
+    return canvas
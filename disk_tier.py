@@ -0,0 +1,88 @@
+"""On-disk cache tier shared by the layer and output caches.
+
+Each entry is a body file (<key>.bin) and a JSON metadata file
+(<key>.json) in one directory, which every worker process can use at once.
+Files are written under names unique to the writing process and thread
+and then renamed into place, so readers never see half a file and
+concurrent writers never clobber each other's temporary files. The least
+recently used bodies are removed once the directory is over its budget.
+"""
+import json
+import os
+import threading
+
+
+class DiskTier:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory  # None turns the tier off
+        self.max_bytes = max_bytes
+
+    def _paths(self, key):
+        return os.path.join(self.directory, key + '.bin'), os.path.join(self.directory, key + '.json')
+
+    def _write(self, path, data):
+        temp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(temp, 'wb') as f:
+                f.write(data)
+            os.replace(temp, path)
+        except OSError:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            raise
+
+    def load(self, key):
+        # (body, metadata) for a key, or None if it isn't there or can't be read
+        if not self.directory:
+            return None
+        body_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with open(body_path, 'rb') as f:
+                body = f.read()
+            os.utime(body_path)  # Mark as recently used for eviction
+        except (OSError, ValueError):
+            return None
+        return body, meta
+
+    def store(self, key, body, meta):
+        """Write an entry; body=None only replaces its metadata.
+
+        Returns how many entries were evicted to make room. Raises OSError.
+        """
+        if not self.directory:
+            return 0
+        body_path, meta_path = self._paths(key)
+        os.makedirs(self.directory, exist_ok=True)
+        if body is not None:
+            self._write(body_path, body)
+        self._write(meta_path, json.dumps(meta).encode('utf-8'))
+        return self.evict() if body is not None else 0
+
+    def evict(self):
+        # Remove least recently used bodies until the tier is within budget; returns how many went
+        bodies = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.bin'):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                bodies.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in bodies)
+        evicted = 0
+        for _, size, path in sorted(bodies):
+            if total <= self.max_bytes:
+                break
+            for stale in (path, path[:-len('.bin')] + '.json'):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+            total -= size
+            evicted += 1
+        return evicted
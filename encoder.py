@@ -0,0 +1,257 @@
+import os
+import struct
+import threading
+import zlib
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, features
+
+import metrics
+
+try:
+    import pillow_avif  # noqa: F401  Registers the AVIF plugin with Pillow
+except ImportError:
+    pillow_avif = None
+
+MIME_TYPES = {
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+    'avif': 'image/avif',
+    'gif': 'image/gif',
+    'pdf': 'application/pdf',
+}
+EXTENSIONS = {mime_type: extension for extension, mime_type in MIME_TYPES.items()}
+
+# Formats "auto" tries, in order; the smallest result wins (override with environment variables)
+AUTO_FORMATS = [name.strip() for name in os.environ.get('ENCODE_AUTO_FORMATS', 'webp,jpeg').split(',')]
+
+# Formats whose encoders write as they go, so sending them as a Stream gets bytes out early.
+# WebP and AVIF produce everything at the end, and the PDF writer needs a real file.
+STREAMABLE = ('png', 'jpeg', 'gif')
+
+# Settings used when the request doesn't give its own
+DEFAULT_OPTIONS = {
+    'png': {'compress_level': int(os.environ.get('PNG_COMPRESS_LEVEL', 6))},
+    'jpeg': {'quality': int(os.environ.get('JPEG_QUALITY', 75))},
+    'webp': {'quality': int(os.environ.get('WEBP_QUALITY', 80)), 'method': int(os.environ.get('WEBP_METHOD', 4))},
+    'avif': {'quality': int(os.environ.get('AVIF_QUALITY', 75)), 'speed': int(os.environ.get('AVIF_SPEED', 8))},
+    'gif': {},
+    'pdf': {},
+}
+
+# Which request options each format understands; others are ignored, so one set works for "auto"
+FORMAT_OPTIONS = {
+    'png': ('compress_level', 'optimize', 'quantize', 'interlace'),
+    'jpeg': ('quality', 'progressive', 'subsampling', 'optimize'),
+    'webp': ('quality', 'lossless', 'method'),
+    'avif': ('quality', 'speed'),
+    'gif': ('quantize',),
+    'pdf': (),
+}
+
+# Allowed values: (low, high) for whole numbers, bool for flags, or a tuple of choices
+_OPTION_RANGES = {
+    'quality': (1, 100),
+    'compress_level': (0, 9),
+    'quantize': (2, 256),  # Number of palette colours for PNG and GIF
+    'method': (0, 6),  # WebP effort: higher is smaller and slower
+    'speed': (0, 10),  # AVIF speed: higher is faster and larger
+    'progressive': bool,
+    'optimize': bool,
+    'lossless': bool,
+    'interlace': bool,  # Adam7 PNG, which viewers can show coarse-to-fine while it downloads
+    'subsampling': ('4:4:4', '4:2:2', '4:2:0'),
+}
+
+
+def available(output_format):
+    # Whether this server can produce the format
+    if output_format not in MIME_TYPES:
+        return False
+    if output_format == 'webp':
+        return features.check('webp')
+    if output_format == 'avif':
+        return pillow_avif is not None
+    return True
+
+
+def parse_options(options):
+    # Validate the request's encoder settings; raises ValueError describing the first bad one
+    if options is None:
+        return {}
+    if not isinstance(options, dict):
+        raise ValueError("'encode' must be an object of encoder settings")
+    for name, value in options.items():
+        allowed = _OPTION_RANGES.get(name)
+        if allowed is None:
+            raise ValueError(f"Unknown encoder setting '{name}'")
+        if allowed is bool:
+            if not isinstance(value, bool):
+                raise ValueError(f"Encoder setting '{name}' must be true or false")
+        elif isinstance(allowed, tuple) and isinstance(allowed[0], str):
+            if value not in allowed:
+                raise ValueError(f"Encoder setting '{name}' must be one of {', '.join(allowed)}")
+        elif not isinstance(value, int) or isinstance(value, bool) or not allowed[0] <= value <= allowed[1]:
+            raise ValueError(f"Encoder setting '{name}' must be a whole number from {allowed[0]} to {allowed[1]}")
+    return dict(options)
+
+
+# Adam7 passes: (first row, first column, row step, column step)
+_ADAM7 = ((0, 0, 8, 8), (0, 4, 8, 8), (4, 0, 8, 4), (0, 2, 4, 4), (2, 0, 4, 2), (0, 1, 2, 2), (1, 0, 2, 1))
+
+
+def _png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def _save_interlaced_png(image, output, compress_level):
+    # Pillow only writes non-interlaced PNG, so Adam7 files are put together here. Each pass is
+    # written as soon as it is compressed, so a streamed response starts with the coarsest pass.
+    if image.mode == 'P':
+        color_type, pixels = 3, np.asarray(image)[..., np.newaxis]
+    else:
+        image = image.convert('RGB')
+        color_type, pixels = 2, np.asarray(image)
+    width, height = image.size
+    output.write(b'\x89PNG\r\n\x1a\n' + _png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 1)))
+    if color_type == 3:
+        output.write(_png_chunk(b'PLTE', bytes(image.getpalette()[:3 * (int(pixels.max()) + 1)])))
+
+    compressor = zlib.compressobj(compress_level)
+    for row, column, row_step, column_step in _ADAM7:
+        rows = pixels[row::row_step, column::column_step]
+        if not rows.size:
+            continue
+        # "Up" filter (each scanline minus the one above it) suits photos; palette indices are left as they are
+        filtered = rows.copy()
+        if color_type == 2:
+            filtered[1:] -= rows[:-1]
+        lines = np.empty((rows.shape[0], 1 + rows.shape[1] * rows.shape[2]), dtype=np.uint8)
+        lines[:, 0] = 2 if color_type == 2 else 0
+        lines[:, 1:] = filtered.reshape(rows.shape[0], -1)
+        data = compressor.compress(lines.tobytes()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        output.write(_png_chunk(b'IDAT', data))
+    output.write(_png_chunk(b'IDAT', compressor.flush()) + _png_chunk(b'IEND', b''))
+
+
+def _save(canvas, output_format, options, output=None):
+    # Encode into output (any object with write()), or into memory and return the bytes
+    settings = dict(DEFAULT_OPTIONS[output_format])
+    settings.update((name, value) for name, value in options.items() if name in FORMAT_OPTIONS[output_format])
+    target = output if output is not None else BytesIO()
+    if output_format in ('png', 'gif'):
+        colors = settings.pop('quantize', None)
+        if colors or output_format == 'gif':
+            # A palette image is much smaller for flat artwork; fast octree keeps the cost low
+            canvas = canvas.convert("RGB").quantize(colors or 256, method=Image.Quantize.FASTOCTREE)
+        if settings.pop('interlace', False):
+            _save_interlaced_png(canvas, target, settings['compress_level'])
+        else:
+            canvas.save(target, output_format.upper(), **settings)
+    elif output_format == 'pdf':
+        # Save as a single-page PDF
+        canvas.convert("RGB").save(target, 'PDF', **settings)
+    else:
+        # The canvas is composited over white, so dropping alpha loses nothing (JPEG does not support it)
+        canvas.convert("RGB").save(target, output_format.upper(), **settings)
+    return target.getvalue() if output is None else None
+
+
+def encode(canvas, output_format, options=None):
+    """Encode the canvas into memory and return (bytes, mime type).
+
+    options are settings from parse_options(). "auto" encodes with each of
+    AUTO_FORMATS and keeps the smallest. Unknown formats fall back to PNG.
+    """
+    with metrics.stage('encode'):
+        return _encode(canvas, output_format, options or {})
+
+
+def _encode(canvas, output_format, options):
+    if output_format == 'auto':
+        results = [(_save(canvas, name, options), name) for name in AUTO_FORMATS if available(name)]
+        results = results or [(_save(canvas, 'png', options), 'png')]
+        body, output_format = min(results, key=lambda result: len(result[0]))
+        return body, MIME_TYPES[output_format]
+    if output_format not in MIME_TYPES:
+        # Default to PNG
+        output_format = 'png'
+    return _save(canvas, output_format, options), MIME_TYPES[output_format]
+
+
+class Stream:
+    """Output that is handed out while it is still being encoded.
+
+    The encoder runs on its own thread and writes into this object; any
+    number of readers iterate over it and each gets every chunk from the
+    start, as soon as it is written. Iterating raises the encoder's error,
+    if it fails.
+    """
+    def __init__(self, canvas, output_format, options=None):
+        if output_format not in STREAMABLE:
+            raise ValueError(f'{output_format} output cannot be streamed')
+        self.mime_type = MIME_TYPES[output_format]
+        self._chunks = []
+        self._written = 0
+        self._done = False
+        self.error = None  # The exception the encoder raised, if it failed
+        self._callbacks = []
+        self._changed = threading.Condition()
+        run = metrics.copy_context().run  # Count the encode towards the request that started it
+        threading.Thread(target=run, args=(self._encode, canvas, output_format, options or {}), daemon=True).start()
+
+    def _encode(self, canvas, output_format, options):
+        try:
+            with metrics.stage('encode'):
+                _save(canvas, output_format, options, self)
+        except Exception as e:
+            self.error = e
+        with self._changed:
+            self._done = True
+            self._changed.notify_all()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    # File methods the encoders use
+    def write(self, data):
+        data = bytes(data)
+        with self._changed:
+            self._chunks.append(data)
+            self._written += len(data)
+            self._changed.notify_all()
+        return len(data)
+
+    def tell(self):
+        return self._written
+
+    def flush(self):
+        pass
+
+    def __iter__(self):
+        index = 0
+        while True:
+            with self._changed:
+                while index == len(self._chunks) and not self._done:
+                    self._changed.wait()
+                chunks, done = self._chunks[index:], self._done
+            index += len(chunks)
+            yield from chunks
+            if done:
+                if self.error is not None:
+                    raise self.error
+                return
+
+    def add_done_callback(self, callback):
+        # Call callback(stream) once encoding has finished or failed (right away if it already has)
+        with self._changed:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def result(self):
+        # The whole output, once it is finished (not getvalue(), which the PDF writer would call halfway)
+        return b''.join(self)
@@ -0,0 +1,404 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# Limits for outgoing layer/font downloads (override with environment variables)
+FETCH_TIMEOUT = float(os.environ.get('FETCH_TIMEOUT', 10))
+MAX_CONCURRENT_FETCHES = int(os.environ.get('MAX_CONCURRENT_FETCHES', 16))  # Across all hosts
+MAX_FETCHES_PER_HOST = int(os.environ.get('MAX_FETCHES_PER_HOST', 6))  # Per scheme://host:port
+# Longest a download waits for a free slot for its host; giving up counts as a failure for the host's circuit
+FETCH_SLOT_WAIT = float(os.environ.get('FETCH_SLOT_WAIT', 5))
+MAX_DOWNLOAD_BYTES = int(os.environ.get('MAX_DOWNLOAD_BYTES', 50 * 1024 * 1024))  # Largest body accepted from a URL
+CHUNK_SIZE = 64 * 1024
+DECODE_THREADS = int(os.environ.get('DECODE_THREADS', os.cpu_count() or 2))  # Threads for run(); Pillow releases the GIL
+
+# Per-host circuit breaker: after BREAKER_FAILURES failures in a row a host is skipped without
+# trying it for BREAKER_COOLDOWN seconds, then a single trial request decides whether it is back
+BREAKER_FAILURES = int(os.environ.get('BREAKER_FAILURES', 5))
+BREAKER_COOLDOWN = float(os.environ.get('BREAKER_COOLDOWN', 30))
+
+# Hedging: when a download is slower than usual for its host, send a duplicate and take whichever
+# answers first. The delay is the host's recent p95 (at least HEDGE_MIN_DELAY), or HEDGE_DELAY until
+# there is enough history; 0 turns hedging off. At most HEDGE_MAX_FRACTION of downloads are hedged.
+HEDGE_DELAY = float(os.environ.get('HEDGE_DELAY', 1.0))
+HEDGE_MIN_DELAY = float(os.environ.get('HEDGE_MIN_DELAY', 0.05))
+HEDGE_MAX_FRACTION = float(os.environ.get('HEDGE_MAX_FRACTION', 0.1))
+# Hedges in flight at once across all hosts. A hedge is only sent if this and its host both have a
+# free slot right then; otherwise the download just carries on.
+MAX_CONCURRENT_HEDGES = int(os.environ.get('MAX_CONCURRENT_HEDGES', 4))
+
+# One shared session so connections (and TLS handshakes) are reused between requests
+session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=MAX_FETCHES_PER_HOST)
+session.mount('http://', _adapter)
+session.mount('https://', _adapter)
+
+# A download only gets one of these threads once its host has a free slot, so a slow host holds at
+# most MAX_FETCHES_PER_HOST of them and downloads from other hosts never queue behind its backlog
+_downloads = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_FETCHES, thread_name_prefix='fetch')
+# Individual attempts run here, so a download can take a hedge's answer without waiting for its own
+_attempts = ThreadPoolExecutor(max_workers=2 * MAX_CONCURRENT_FETCHES, thread_name_prefix='fetch-attempt')
+# Hedges have their own threads, taken without waiting, so they never queue behind ordinary attempts
+_hedges = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_HEDGES, thread_name_prefix='fetch-hedge')
+_hedge_slots = threading.BoundedSemaphore(MAX_CONCURRENT_HEDGES)
+# Decoding and other CPU work, kept apart so it never waits behind downloads
+_compute = ThreadPoolExecutor(max_workers=DECODE_THREADS, thread_name_prefix='decode')
+_local = threading.local()  # .slot: (Host, whether the download got a slot) for the current download thread
+
+# Waiting downloads' deadlines, (time, sequence, host, waiter), checked by one timer thread
+_deadlines = []
+_deadlines_changed = threading.Condition()
+_sequence = itertools.count()
+_timer = None
+
+
+class Host:
+    # Connection limit and health of one scheme://host:port
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0  # Slots in use, at most MAX_FETCHES_PER_HOST
+        self.waiting = deque()  # Callbacks to start once a slot frees up, oldest first
+        self.failures = 0  # Failures in a row
+        self.open_until = 0.0  # While in the future, the circuit is open and requests fail fast
+        self.trial = False  # A half-open trial request is in flight
+        self.latencies = deque(maxlen=100)  # Seconds taken by recent successful downloads
+        self.requests = 0
+        self.hedges = 0
+
+    def take(self, start, expire):
+        # Call start() holding one of this host's slots: now if one is free, else when one is released.
+        # Nothing blocks while waiting, so a queued download costs no thread. If no slot frees up within
+        # FETCH_SLOT_WAIT, expire() is called instead and the host is charged a failure.
+        with self.lock:
+            if self.active >= MAX_FETCHES_PER_HOST:
+                waiter = (start, expire)
+                self.waiting.append(waiter)
+            else:
+                self.active += 1
+                waiter = None
+        if waiter is None:
+            start()
+        else:
+            _expire_later(self, waiter)
+
+    def try_take(self):
+        # Take a slot only if one is free right now
+        with self.lock:
+            if self.active >= MAX_FETCHES_PER_HOST:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        # Give a slot back, handing it straight to the oldest waiting download if there is one
+        with self.lock:
+            if not self.waiting:
+                self.active -= 1
+                return
+            start, _ = self.waiting.popleft()
+        start()
+
+    def expire(self, waiter):
+        # waiter's FETCH_SLOT_WAIT is up; a host this backed up is counted as failing
+        with self.lock:
+            try:
+                self.waiting.remove(waiter)
+            except ValueError:
+                return  # It got a slot in time
+        self.failed()
+        waiter[1]()
+
+    def acquire(self):
+        # Block the calling thread until it holds a slot, for callers that aren't on a download thread.
+        # Returns False if it gave up after FETCH_SLOT_WAIT.
+        ready = threading.Event()
+        granted = []
+        self.take(lambda: (granted.append(True), ready.set()), ready.set)
+        ready.wait()
+        return bool(granted)
+
+    def allow(self):
+        # Whether a request may go out now; after the cooldown, lets exactly one trial through
+        with self.lock:
+            if self.failures < BREAKER_FAILURES:
+                return True
+            if time.time() < self.open_until or self.trial:
+                return False
+            self.trial = True
+            return True
+
+    def succeeded(self, seconds):
+        with self.lock:
+            if self.failures >= BREAKER_FAILURES:
+                print("Circuit closed: host is answering again")
+            self.failures, self.trial = 0, False
+            self.latencies.append(seconds)
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.failures >= BREAKER_FAILURES:
+                self.open_until = time.time() + BREAKER_COOLDOWN
+
+    def is_open(self):
+        with self.lock:
+            return self.failures >= BREAKER_FAILURES
+
+    def hedge_delay(self):
+        # Seconds to wait before hedging a request, or None if this one shouldn't be hedged
+        with self.lock:
+            self.requests += 1
+            if HEDGE_DELAY <= 0 or self.hedges >= HEDGE_MAX_FRACTION * self.requests:
+                return None
+            if len(self.latencies) < 20:
+                return HEDGE_DELAY
+            recent = sorted(self.latencies)
+            return max(HEDGE_MIN_DELAY, recent[int(0.95 * (len(recent) - 1))])
+
+    def hedged(self):
+        with self.lock:
+            self.hedges += 1
+
+
+_hosts = {}
+_hosts_lock = threading.Lock()
+
+
+def _host(url):
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    with _hosts_lock:
+        host = _hosts.get(key)
+        if host is None:
+            host = _hosts[key] = Host()
+    return host
+
+
+def _expire_later(host, waiter):
+    # Have the timer thread call host.expire(waiter) after FETCH_SLOT_WAIT
+    global _timer
+    with _deadlines_changed:
+        heapq.heappush(_deadlines, (time.monotonic() + FETCH_SLOT_WAIT, next(_sequence), host, waiter))
+        if _timer is None or not _timer.is_alive():  # Not started yet, or lost in a fork
+            _timer = threading.Thread(target=_expire_waiting, name='fetch-slot-timer', daemon=True)
+            _timer.start()
+        _deadlines_changed.notify()
+
+
+def _expire_waiting():
+    while True:
+        with _deadlines_changed:
+            while not _deadlines:
+                _deadlines_changed.wait()
+            remaining = _deadlines[0][0] - time.monotonic()
+            if remaining > 0:
+                _deadlines_changed.wait(remaining)
+                continue
+            _, _, host, waiter = heapq.heappop(_deadlines)
+        host.expire(waiter)
+
+
+def open_circuits():
+    # How many hosts are currently being skipped
+    with _hosts_lock:
+        hosts = list(_hosts.values())
+    return sum(1 for host in hosts if host.is_open())
+
+
+class DownloadRejected(Exception):
+    # Raised while streaming a body that is over a budget, to stop the download early
+    pass
+
+
+def _read_body(response, inspect=None):
+    # Stream the body in chunks, giving up as soon as it is over MAX_DOWNLOAD_BYTES.
+    # inspect(head) sees the bytes received so far after each chunk until it returns True; it may raise
+    # DownloadRejected to stop before the rest is downloaded.
+    length = response.headers.get('Content-Length', '')
+    if length.isdigit() and int(length) > MAX_DOWNLOAD_BYTES:
+        raise DownloadRejected(f'body is {length} bytes, over the {MAX_DOWNLOAD_BYTES} byte limit')
+    chunks, total = [], 0
+    for chunk in response.iter_content(CHUNK_SIZE):
+        total += len(chunk)
+        if total > MAX_DOWNLOAD_BYTES:
+            raise DownloadRejected(f'body is over the {MAX_DOWNLOAD_BYTES} byte limit')
+        chunks.append(chunk)
+        if inspect is not None and inspect(b''.join(chunks)):
+            inspect = None
+    return b''.join(chunks)
+
+
+def _attempt(url, host, headers, inspect):
+    # One try at a download; returns (response, body, outcome) and updates the host's health
+    start = time.perf_counter()
+    try:
+        with session.get(url, headers=headers, timeout=FETCH_TIMEOUT, stream=True) as response:
+            body = _read_body(response, inspect) if response.status_code == 200 else None
+    except DownloadRejected as e:
+        print(f"Rejected download from {url}: {e}")
+        host.succeeded(time.perf_counter() - start)  # The host answered; the body was the problem
+        return None, None, 'rejected'
+    except Exception as e:
+        print(f"Error fetching {url}: {e}")
+        host.failed()
+        return None, None, 'network'
+    if response.status_code >= 500:
+        host.failed()
+        return response, body, 'status'
+    host.succeeded(time.perf_counter() - start)
+    return response, body, 'ok' if response.status_code in (200, 304) else 'status'
+
+
+def get(url, headers=None, inspect=None):
+    """Issue a streaming GET under the per-host limit.
+
+    Returns (response, body): body is the bytes of a 200 response, read with
+    _read_body() so it never goes over MAX_DOWNLOAD_BYTES, and None for any
+    other status. Returns (None, None) on a network error, a rejected body,
+    while the host's circuit is open or if no slot for the host frees up within
+    FETCH_SLOT_WAIT. A download that is slow for its host is hedged with a
+    duplicate request when there is room for one, and the first good answer wins.
+    """
+    start = time.perf_counter()
+    host = _host(url)
+    if not host.allow():
+        print(f"Skipping {url}: too many recent failures from this host")
+        metrics.record_fetch(url, 0.0, 'circuit_open')
+        return None, None
+
+    # Downloads started with submit() already hold a slot for their host (or gave up waiting for one);
+    # anyone else waits for one here. The slot goes to the first attempt and is released when it
+    # finishes, even if a hedge answered first.
+    slot = getattr(_local, 'slot', None)
+    if slot is not None and slot[0] is host:
+        _local.slot = None
+        granted = slot[1]
+    else:
+        granted = host.acquire()
+    if not granted:
+        print(f"Gave up on {url}: no free connection to its host after {FETCH_SLOT_WAIT:g}s")
+        metrics.record_fetch(url, time.perf_counter() - start, 'slot_timeout')
+        return None, None
+    first = _attempts.submit(_attempt, url, host, headers, inspect)
+    first.add_done_callback(lambda _: host.release())
+    return _get(url, host, headers, inspect, first, start)
+
+
+def _hedge(url, host, headers, inspect):
+    # A duplicate attempt, holding its own host slot and hedge slot
+    try:
+        return _attempt(url, host, headers, inspect)
+    finally:
+        host.release()
+        _hedge_slots.release()
+
+
+def _start_hedge(url, host, headers, inspect):
+    # A hedge future, or None if there is no spare capacity for one right now
+    if not host.allow() or not _hedge_slots.acquire(blocking=False):
+        return None
+    if not host.try_take():
+        _hedge_slots.release()
+        return None
+    host.hedged()
+    metrics.HEDGES.inc()
+    return _hedges.submit(_hedge, url, host, headers, inspect)
+
+
+def _get(url, host, headers, inspect, first, start):
+    pending = {first}
+    delay = host.hedge_delay()
+    if delay is not None:
+        done, pending = wait(pending, timeout=delay)
+        hedge = _start_hedge(url, host, headers, inspect) if not done else None
+        if hedge is not None:
+            pending.add(hedge)
+        else:
+            pending |= done
+
+    # Take the first attempt that succeeds; otherwise report the last failure
+    while True:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        results = [future.result() for future in done]
+        for response, body, outcome in results:
+            if outcome == 'ok':
+                break
+        else:
+            if pending:
+                continue
+        metrics.record_fetch(url, time.perf_counter() - start, outcome)
+        return response, body
+
+
+def fetch_url(url):
+    # Download one URL, returning the body bytes or None if it failed
+    response, body = get(url)
+    if response is None:
+        return None
+    if response.status_code != 200:
+        print(f"Failed to fetch: {url}, Status Code: {response.status_code}")
+        return None
+    return body
+
+
+def _download(host, granted, future, context, fetch, url):
+    # Runs on a download thread holding a slot for the host, which get() takes over through _local;
+    # if the wait for a slot timed out (granted False), get() fails straight away instead
+    _local.slot = (host, granted)
+    try:
+        result = context.run(fetch, url)
+    except BaseException as e:
+        future.set_exception(e)
+    else:
+        future.set_result(result)
+    finally:
+        if granted and _local.slot is not None:  # fetch() never downloaded (e.g. the URL had just been cached)
+            host.release()
+        _local.slot = None
+
+
+def submit(url, fetch=fetch_url, cached=None):
+    """Start fetch(url) in the background and return its future.
+
+    cached(url), if given, is tried first on the calling thread, and a result
+    other than None is returned without using a download thread. Otherwise
+    fetch() runs on a download thread once the URL's host has a free slot. It
+    is timed as part of the current request.
+    """
+    future = Future()
+    result = cached(url) if cached is not None else None
+    if result is not None:
+        future.set_result(result)
+        return future
+    host = _host(url)
+    context = metrics.copy_context()
+    host.take(lambda: _downloads.submit(_download, host, True, future, context, fetch, url),
+              lambda: _downloads.submit(_download, host, False, future, context, fetch, url))
+    return future
+
+
+def fetch_all(urls, fetch=fetch_url, cached=None):
+    # Fetch every non-blank URL at the same time; returns {url: result or None}
+    futures = {}
+    for url in urls:
+        if not url.strip() or url in futures:  # Skip empty or blank URLs and repeats
+            continue
+        print(f"Fetching from: {url}")
+        futures[url] = submit(url, fetch, cached)
+    return {url: future.result() for url, future in futures.items()}
+
+
+def run(fn, *args):
+    # Run CPU-bound work (e.g. decoding) on its own pool and return its future
+    return _compute.submit(metrics.copy_context().run, fn, *args)
@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from PIL import ImageFont
+
+import fetcher
+import singleflight
+
+# Font registry sizing (override with environment variables)
+FONT_CACHE_MAX_BYTES = int(os.environ.get('FONT_CACHE_MAX_BYTES', 64 * 1024 * 1024))  # Downloaded font files
+FONT_CACHE_MAX_FONTS = int(os.environ.get('FONT_CACHE_MAX_FONTS', 128))  # Parsed (font_url, font_size) objects
+FONT_PRELOAD_FILE = os.environ.get('FONT_PRELOAD_FILE')  # JSON list of {"font_url": ..., "sizes": [...]}
+
+_font_bytes = OrderedDict()  # font_url -> bytes, least recently used first
+_font_bytes_total = 0
+_fonts = OrderedDict()  # (font_url, font_size) -> FreeTypeFont, least recently used first
+_lock = threading.Lock()
+_downloads = singleflight.Group('font')
+
+
+def cached_bytes(font_url):
+    # The font file for a URL if it has already been downloaded, else None
+    with _lock:
+        content = _font_bytes.get(font_url)
+        if content is not None:
+            _font_bytes.move_to_end(font_url)
+        return content
+
+
+def get_font_bytes(font_url):
+    # Return the font file for a URL, downloading it only the first time; None if the download failed
+    global _font_bytes_total
+    content = cached_bytes(font_url)
+    if content is not None:
+        return content
+
+    # Concurrent requests for a font that isn't cached yet share one download
+    content = _downloads.do(font_url, fetcher.fetch_url, font_url)
+    if content is None:
+        return None  # Don't remember failures so the next request tries again
+
+    with _lock:
+        if font_url not in _font_bytes and len(content) <= FONT_CACHE_MAX_BYTES:
+            _font_bytes[font_url] = content
+            _font_bytes_total += len(content)
+            while _font_bytes_total > FONT_CACHE_MAX_BYTES:
+                _, evicted = _font_bytes.popitem(last=False)
+                _font_bytes_total -= len(evicted)
+    return content
+
+
+def get_font(font_url, font_size, content=None):
+    # Return a parsed FreeTypeFont for (font_url, font_size); raises if the font can't be fetched or parsed.
+    # Pass content to parse font bytes that were downloaded elsewhere (e.g. in another process).
+    key = (font_url, font_size)
+    with _lock:
+        font = _fonts.get(key)
+        if font is not None:
+            _fonts.move_to_end(key)
+            return font
+
+    if content is None:
+        content = get_font_bytes(font_url)
+    if content is None:
+        raise IOError(f'Failed to fetch font from URL: {font_url}')
+    font = ImageFont.truetype(BytesIO(content), font_size)
+
+    with _lock:
+        _fonts[key] = font
+        while len(_fonts) > FONT_CACHE_MAX_FONTS:
+            _fonts.popitem(last=False)
+    return font
+
+
+def preload(path=FONT_PRELOAD_FILE):
+    # Download and parse the fonts listed in the preload file so the first requests don't pay for them
+    if not path:
+        return
+    try:
+        with open(path) as f:
+            entries = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error reading font preload file {path}: {e}")
+        return
+    if not isinstance(entries, list):
+        print(f"Error reading font preload file {path}: expected a list of {{\"font_url\": ..., \"sizes\": [...]}}")
+        return
+
+    # Skip malformed entries rather than failing startup over them
+    fonts = []
+    for entry in entries:
+        font_url = entry.get('font_url') if isinstance(entry, dict) else None
+        sizes = entry.get('sizes', [180]) if isinstance(entry, dict) else None
+        if not isinstance(font_url, str) or not font_url.strip() or not isinstance(sizes, list):
+            print(f"Skipping font preload entry {entry!r}: needs a font_url and optionally a list of sizes")
+            continue
+        fonts.append((font_url, sizes))
+
+    # Fetch all font files at the same time, then parse each requested size
+    fetcher.fetch_all([font_url for font_url, _ in fonts], get_font_bytes, cached=cached_bytes)
+    for font_url, sizes in fonts:
+        for size in sizes:
+            try:
+                get_font(font_url, size)
+            except Exception as e:
+                print(f"Error preloading font {font_url} at {size}px: {e}")
+    print(f"Preloaded {len(_fonts)} fonts from {path}")
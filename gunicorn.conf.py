@@ -0,0 +1,50 @@
+# Production server settings, picked up automatically by:
+#
+#     gunicorn app_v2:app
+#
+# Each worker process serves requests on a pool of threads. Layer and font downloads
+# already run concurrently on fetcher's shared I/O pool, so a request thread only waits
+# on the network once per request rather than once per layer.
+import os
+import shutil
+import tempfile
+
+bind = f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_WORKERS', os.cpu_count() or 2))  # Worker processes
+os.environ['WEB_WORKERS'] = str(workers)  # Tells the workers how many share the box (see admission.py)
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 8))  # Request threads per worker
+timeout = int(os.environ.get('WEB_TIMEOUT', 120))  # Kill a worker stuck on one request this long
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))  # Seconds to drain in-flight requests on shutdown
+keepalive = int(os.environ.get('WEB_KEEPALIVE', 5))
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 0))  # Recycle workers after this many requests; 0 never
+max_requests_jitter = max_requests // 10
+accesslog = os.environ.get('WEB_ACCESS_LOG', '-') or None  # Empty to turn access logging off
+
+# Async jobs and templates are looked up by whichever worker gets the request, so every worker shares one
+# job store and one template directory. Without ones of their own, the server gets ones that last as long as it does.
+_own_job_db = 'JOB_DB' not in os.environ
+os.environ.setdefault('JOB_DB', os.path.join(tempfile.gettempdir(), f'image-combiner-jobs-{os.getpid()}.sqlite3'))
+_own_templates_dir = 'TEMPLATES_DIR' not in os.environ
+if _own_templates_dir:
+    os.environ['TEMPLATES_DIR'] = tempfile.mkdtemp(prefix='image-combiner-templates-')
+
+
+def worker_exit(server, worker):
+    # By now the worker has stopped accepting connections and finished its requests;
+    # let queued async jobs and pool renders finish before the process goes away
+    import jobs
+    import render_pool
+    jobs.shutdown()
+    render_pool.shutdown()
+
+
+def on_exit(server):
+    if _own_job_db:
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(os.environ['JOB_DB'] + suffix)
+            except OSError:
+                pass
+    if _own_templates_dir:
+        shutil.rmtree(os.environ['TEMPLATES_DIR'], ignore_errors=True)
@@ -0,0 +1,186 @@
+"""Async renders: a bounded queue of jobs rendered by worker processes.
+
+Jobs and their results live in a SQLite file (JOB_DB) rather than in this
+process's memory, so under gunicorn any web worker can answer for a job
+another one accepted. Each web worker renders the jobs it accepted on its
+own pool of worker processes.
+"""
+import atexit
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+import render
+import worker_pool
+
+# Async rendering limits (override with environment variables)
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', worker_pool.default_workers()))  # Worker processes per web worker
+JOB_QUEUE_MAX = int(os.environ.get('JOB_QUEUE_MAX', 64))  # Queued + running jobs before new ones get a 429
+JOB_RESULT_TTL = float(os.environ.get('JOB_RESULT_TTL', 600))  # Seconds a finished result is kept
+JOB_MAX_WAIT = float(os.environ.get('JOB_MAX_WAIT', 30))  # Longest a status request may long-poll
+JOB_POLL_INTERVAL = 0.2  # How often a long-poll checks for jobs finished by other processes
+# Job store shared by every process that serves requests (gunicorn.conf.py sets one up for its workers);
+# without it, a private file for this process that is removed when it exits
+JOB_DB = os.environ.get('JOB_DB')
+_PRIVATE_DB = os.path.join(tempfile.gettempdir(), f'image-combiner-jobs-{os.getpid()}.sqlite3')
+
+
+class QueueFull(Exception):
+    # Raised by submit() when JOB_QUEUE_MAX jobs are already waiting or running
+    def __init__(self, retry_after):
+        super().__init__('Render queue is full')
+        self.retry_after = retry_after
+
+
+class Job:
+    # A snapshot of one row of the job store
+    def __init__(self, row):
+        (self.id, self.status, self.owner, self.created, self.finished,
+         self.mime_type, self.error, self.error_status, self.body) = row
+
+    def describe(self):
+        info = {'job_id': self.id, 'status': self.status}
+        if self.status == 'failed':
+            info['error'] = self.error
+        if self.finished:
+            info['expires_in'] = max(0, round(self.finished + JOB_RESULT_TTL - time.time()))
+        return info
+
+
+_pool = worker_pool.WorkerPool(JOB_WORKERS)
+_changed = threading.Condition()  # Wakes long-polling status requests when a job of this process finishes
+_local = threading.local()
+
+
+def _path():
+    return JOB_DB or _PRIVATE_DB
+
+
+def _db():
+    # One connection per thread; autocommit, with writers waiting for each other instead of failing
+    db = getattr(_local, 'db', None)
+    if db is None:
+        db = _local.db = sqlite3.connect(_path(), timeout=30, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT, owner INTEGER, created REAL, '
+                   'finished REAL, mime_type TEXT, error TEXT, error_status INTEGER, body BLOB)')
+    return db
+
+
+@atexit.register
+def _remove_private_db():
+    if JOB_DB:
+        return
+    for suffix in ('', '-wal', '-shm'):
+        try:
+            os.remove(_PRIVATE_DB + suffix)
+        except OSError:
+            pass
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass  # Exists, but belongs to someone else
+    return True
+
+
+def _purge():
+    # Drop expired results, and fail jobs whose web worker went away without finishing them
+    db = _db()
+    now = time.time()
+    db.execute('DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?', (now - JOB_RESULT_TTL,))
+    for job_id, owner in db.execute('SELECT id, owner FROM jobs WHERE finished IS NULL AND owner != ?',
+                                    (os.getpid(),)).fetchall():
+        if not _alive(owner):
+            db.execute("UPDATE jobs SET status = 'failed', error = ?, error_status = 500, finished = ? WHERE id = ?",
+                       ('The server process rendering this job exited', now, job_id))
+
+
+def _run(path, job_id, data):
+    # Runs in a worker process, which is told the store's path since a private one is named after the server
+    db = sqlite3.connect(path, timeout=30, isolation_level=None)
+    try:
+        db.execute("UPDATE jobs SET status = 'running' WHERE id = ? AND status = 'queued'", (job_id,))
+    finally:
+        db.close()
+    return render.render(data)
+
+
+def _finished(job_id, future):
+    try:
+        body, mime_type = future.result()
+        fields = ('done', mime_type, None, None, body)
+    except render.RenderError as e:
+        fields = ('failed', None, str(e), e.status, None)
+    except Exception as e:
+        print(f"Error rendering job {job_id}: {e}")
+        fields = ('failed', None, str(e), 500, None)
+    _db().execute('UPDATE jobs SET status = ?, mime_type = ?, error = ?, error_status = ?, body = ?, finished = ? '
+                  'WHERE id = ?', fields + (time.time(), job_id))
+    with _changed:
+        _changed.notify_all()
+
+
+def submit(data):
+    # Queue a /combine-images payload for rendering in a worker process and return its Job
+    # Reject bad payloads now rather than after they've queued
+    if isinstance(data, dict) and 'pages' in data:
+        render.parse_pages(data)
+    else:
+        render.parse_request(data)
+    db = _db()
+    job_id = uuid.uuid4().hex
+    db.execute('BEGIN IMMEDIATE')  # Count and insert as one step, so processes can't overfill the queue together
+    try:
+        _purge()
+        pending = db.execute('SELECT COUNT(*) FROM jobs WHERE finished IS NULL').fetchone()[0]
+        if pending >= JOB_QUEUE_MAX:
+            # Rough guess: the queue drains a worker's worth of jobs every couple of seconds
+            raise QueueFull(retry_after=max(1, round(2 * pending / JOB_WORKERS)))
+        db.execute("INSERT INTO jobs (id, status, owner, created) VALUES (?, 'queued', ?, ?)",
+                   (job_id, os.getpid(), time.time()))
+        db.execute('COMMIT')
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+
+    try:
+        # Job workers don't share this process's template registry, so they get the templates' fields
+        future = _pool.submit(_run, _path(), job_id, render.inline_templates(data))
+    except Exception:
+        db.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+        raise
+    future.add_done_callback(lambda future: _finished(job_id, future))
+    return _load(job_id)
+
+
+def _load(job_id, body=False):
+    row = _db().execute('SELECT id, status, owner, created, finished, mime_type, error, error_status, '
+                        + ('body' if body else 'NULL') + ' FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    return Job(row) if row is not None else None
+
+
+def get(job_id, wait=0, body=False):
+    # Look up a job, waiting up to `wait` seconds (capped at JOB_MAX_WAIT) for it to finish; body=True loads the result
+    deadline = time.time() + min(max(wait, 0), JOB_MAX_WAIT)
+    _purge()
+    job = _load(job_id, body)
+    while job is not None and job.status in ('queued', 'running'):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        with _changed:
+            _changed.wait(min(remaining, JOB_POLL_INTERVAL))
+        job = _load(job_id, body)
+    return job
+
+
+def shutdown():
+    _pool.shutdown()
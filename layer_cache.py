@@ -0,0 +1,499 @@
+import hashlib
+import io
+import mmap
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+import compositor
+import disk_tier
+import fetcher
+import metrics
+import shared_pixels
+import singleflight
+
+# Cache sizing (override with environment variables)
+LAYER_CACHE_MAX_BYTES = int(os.environ.get('LAYER_CACHE_MAX_BYTES', 512 * 1024 * 1024))  # Memory tier budget
+LAYER_CACHE_DIR = os.environ.get('LAYER_CACHE_DIR')  # Optional on-disk tier; disabled when unset
+LAYER_CACHE_DISK_MAX_BYTES = int(os.environ.get('LAYER_CACHE_DISK_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+LAYER_CACHE_SIZES_PER_LAYER = int(os.environ.get('LAYER_CACHE_SIZES_PER_LAYER', 4))  # Decoded sizes kept per layer
+MAX_LAYER_PIXELS = int(os.environ.get('MAX_LAYER_PIXELS', 40_000_000))  # Largest width * height accepted for a layer
+HEADER_PROBE_BYTES = 256 * 1024  # How far into a download to look for the image header
+LAYER_CACHE_TTL = float(os.environ.get('LAYER_CACHE_TTL', 60))  # Seconds before revalidating, unless max-age says otherwise
+LAYER_CACHE_STALE_IF_ERROR = float(os.environ.get('LAYER_CACHE_STALE_IF_ERROR', 24 * 3600))  # Seconds past freshness a
+# cached copy may still be used when the origin is down or erroring
+LOCAL_ASSET_ROOT = os.environ.get('LOCAL_ASSET_ROOT')  # Directory served as local:// URLs; disabled when unset
+LOCAL_SCHEME = 'local://'  # Layers named local://<path> are memory-mapped from LOCAL_ASSET_ROOT and pinned
+
+
+class _MapReader(io.RawIOBase):
+    # Read-only file object over a memory map with its own position, so threads can decode one map at once
+    def __init__(self, mapped):
+        self._view = memoryview(mapped)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._view[self._pos:self._pos + len(buffer)]
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._view)}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+def _map(path):
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _open(content):
+    # File object for image bytes, a memory map of them (read in place, not copied) or a local file path
+    if isinstance(content, str):
+        content = _map(content)
+    if isinstance(content, mmap.mmap):
+        return _MapReader(content)
+    return BytesIO(content)
+
+
+def decode(content, size=None):
+    # Decode image bytes to contiguous RGBA pixels at (width, height), or full size when size is None.
+    # Smaller sizes are decoded at reduced resolution where the format allows it.
+    image = Image.open(_open(content))
+    size = tuple(size) if size else image.size
+    if size != image.size:
+        image.draft(None, size)  # JPEG decodes at 1/2, 1/4 or 1/8 scale; no-op for other formats
+    image = image.convert("RGBA")
+    if image.size != size:
+        image = image.resize(size, Image.LANCZOS, reducing_gap=2.0)
+    return np.asarray(image)
+
+
+def _check_pixels(size):
+    # Refuse images that would take too much memory to decode (e.g. decompression bombs)
+    if size[0] * size[1] > MAX_LAYER_PIXELS:
+        raise ValueError(f'image is {size[0]}x{size[1]}, over the {MAX_LAYER_PIXELS} pixel limit')
+
+
+def _check_header(head):
+    # fetcher.get() inspect hook: stop downloading as soon as the header shows an oversized image.
+    # Returns True once the dimensions are known (or we've stopped looking) so the rest can stream in.
+    try:
+        size = Image.open(BytesIO(head)).size
+    except Image.DecompressionBombError as e:
+        raise fetcher.DownloadRejected(str(e))
+    except Exception:
+        return len(head) >= HEADER_PROBE_BYTES  # Header not complete yet; LayerEntry checks again at the end
+    try:
+        _check_pixels(size)
+    except ValueError as e:
+        raise fetcher.DownloadRejected(str(e))
+    return True
+
+
+class LayerEntry:
+    # A downloaded layer: raw bytes, decoded RGBA pixels and the validators to revalidate it.
+    # Local assets have a memory map as their content and the file's path.
+    def __init__(self, url, content, etag=None, last_modified=None, fresh_until=0.0, path=None):
+        self.url = url
+        self.content = content
+        self.path = path
+        self.digest = hashlib.sha256(content).hexdigest()  # Content address of the bytes
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fresh_until = fresh_until
+        self.source_size = None
+        self.error = None
+        self._decoded = OrderedDict()  # (width, height) -> pixels, least recently used first
+        self._shared = {}  # (width, height) -> path, for pixels kept in shared memory
+        self._coverage = {}  # (width, height) -> compositor.Coverage of the decoded pixels
+        self._decoded_lock = threading.Lock()
+        self.accounted_bytes = 0  # What the memory tier currently counts for this entry
+        try:
+            # Only the header is read here; pixels are decoded on demand, at the size they're needed
+            self.source_size = Image.open(_open(content)).size
+            _check_pixels(self.source_size)
+        except Exception as e:
+            self.error = e
+
+    def _lookup(self, size):
+        # Called with _decoded_lock held
+        pixels = self._decoded.get(size)
+        if pixels is not None:
+            self._decoded.move_to_end(size)
+        return pixels
+
+    def _store(self, size, pixels, path=None):
+        # Keep decoded pixels (optionally backed by a shared buffer), dropping the least recently used sizes
+        with self._decoded_lock:
+            self._decoded[size] = pixels
+            self._decoded.move_to_end(size)
+            self._coverage.pop(size, None)
+            replaced = self._shared.pop(size, None)
+            if path:
+                self._shared[size] = path
+            if replaced and replaced != path:
+                shared_pixels.remove(replaced)
+            while len(self._decoded) > LAYER_CACHE_SIZES_PER_LAYER:
+                dropped, _ = self._decoded.popitem(last=False)
+                self._coverage.pop(dropped, None)
+                if dropped in self._shared:
+                    shared_pixels.remove(self._shared.pop(dropped))
+        _reaccount(self)
+
+    def decoded(self, size=None):
+        # Contiguous RGBA pixels at (width, height), or at full size when size is None
+        size = tuple(size) if size else self.source_size
+        with self._decoded_lock:
+            pixels = self._lookup(size)
+        if pixels is not None:
+            return pixels
+
+        try:
+            with metrics.stage('decode'):
+                pixels = decode(self.content, size)
+        except Exception as e:
+            self.error = e
+            raise
+        self._store(size, pixels)
+        return pixels
+
+    def coverage(self, size=None):
+        # Where the pixels at size have ink (see compositor.Coverage), measured once and kept with them
+        size = tuple(size) if size else self.source_size
+        with self._decoded_lock:
+            coverage = self._coverage.get(size)
+        if coverage is None:
+            pixels = self.decoded(size)
+            coverage = compositor.Coverage.of(pixels)
+            with self._decoded_lock:
+                if self._decoded.get(size) is pixels:
+                    self._coverage[size] = coverage
+        return coverage
+
+    def shared(self, size):
+        # Path of a shared-memory copy of the pixels at size, moving already decoded pixels there;
+        # None if that size hasn't been decoded yet
+        size = tuple(size)
+        with self._decoded_lock:
+            pixels = self._lookup(size)
+            path = self._shared.get(size)
+        if pixels is None or path:
+            return path
+        path = shared_pixels.create(pixels.shape)
+        shared_pixels.attach(path, pixels.shape, writable=True)[...] = pixels
+        self._store(size, shared_pixels.attach(path, pixels.shape), path)
+        return path
+
+    def adopt_shared(self, size, path):
+        # Keep pixels that a worker process decoded into a shared buffer
+        size = tuple(size)
+        self._store(size, shared_pixels.attach(path, (size[1], size[0], 4)), path)
+
+    def release(self):
+        # Free the shared buffers once the entry has left the cache
+        with self._decoded_lock:
+            paths, self._shared = list(self._shared.values()), {}
+        for path in paths:
+            shared_pixels.remove(path)
+
+    @property
+    def pixels(self):
+        return self.decoded()
+
+    @property
+    def image(self):
+        # Read-only Image view of the full-size pixels
+        return Image.fromarray(self.pixels, "RGBA")
+
+    @property
+    def size_bytes(self):
+        # Raw bytes plus every decoded size that is being kept
+        with self._decoded_lock:
+            return len(self.content) + sum(pixels.nbytes for pixels in self._decoded.values())
+
+
+_disk = disk_tier.DiskTier(LAYER_CACHE_DIR, LAYER_CACHE_DISK_MAX_BYTES)
+_entries = OrderedDict()  # url -> LayerEntry, least recently used first
+_local = {}  # local:// URL -> (LayerEntry, (mtime, size) of the file it maps); pinned, never evicted
+_loads = singleflight.Group('layer')
+_entries_bytes = 0
+_lock = threading.Lock()
+
+stats = {
+    'hits': 0,  # Served from memory or disk without downloading the body
+    'misses': 0,  # Body had to be downloaded
+    'revalidations': 0,  # Conditional requests sent upstream
+    'not_modified': 0,  # Conditional requests answered with 304
+    'evictions': 0,  # Entries dropped from the memory tier
+    'disk_hits': 0,
+    'disk_evictions': 0,
+    'stale_served': 0,  # Expired copies used because the origin failed
+}
+
+
+def _count(name):
+    with _lock:
+        stats[name] += 1
+
+
+def get_stats():
+    with _lock:
+        pinned = [entry for entry, _ in _local.values()]
+        return dict(stats, entries=len(_entries), bytes=_entries_bytes, max_bytes=LAYER_CACHE_MAX_BYTES,
+                    local_assets=len(pinned), local_bytes=sum(entry.size_bytes for entry in pinned))
+
+
+def _freshness(response):
+    # How long (in seconds) the response may be used without asking the origin again
+    cache_control = response.headers.get('Cache-Control', '')
+    if 'no-cache' in cache_control:
+        return 0.0
+    match = re.search(r'max-age=(\d+)', cache_control)
+    if match:
+        return float(match.group(1))
+    return LAYER_CACHE_TTL
+
+
+def _evict_over_budget():
+    # Called with _lock held
+    global _entries_bytes
+    while _entries_bytes > LAYER_CACHE_MAX_BYTES and _entries:
+        _, evicted = _entries.popitem(last=False)
+        _entries_bytes -= evicted.accounted_bytes
+        evicted.release()
+        stats['evictions'] += 1
+
+
+def _remember(entry):
+    # Store an entry in the memory tier, evicting least recently used entries to stay in budget
+    global _entries_bytes
+    size = entry.size_bytes
+    with _lock:
+        old = _entries.pop(entry.url, None)
+        if old is not None:
+            _entries_bytes -= old.accounted_bytes
+            if old is not entry:
+                old.release()
+        if size > LAYER_CACHE_MAX_BYTES:
+            return  # Too big to ever fit; serve it without caching
+        entry.accounted_bytes = size
+        _entries[entry.url] = entry
+        _entries_bytes += size
+        _evict_over_budget()
+
+
+def _reaccount(entry):
+    # An entry decoded (or dropped) a size; update the budget to match
+    global _entries_bytes
+    size = entry.size_bytes
+    with _lock:
+        if _entries.get(entry.url) is not entry:
+            return
+        _entries_bytes += size - entry.accounted_bytes
+        entry.accounted_bytes = size
+        _evict_over_budget()
+
+
+def is_cached(entry):
+    # Whether this exact entry is currently held by the memory tier (or pinned as a local asset)
+    with _lock:
+        return _entries.get(entry.url) is entry or _local.get(entry.url, (None,))[0] is entry
+
+
+def _lookup(url):
+    with _lock:
+        entry = _entries.get(url)
+        if entry is not None:
+            _entries.move_to_end(url)
+        return entry
+
+
+def peek(url):
+    # The cached entry for a URL if it is in memory and still fresh, else None; never touches the network
+    if url.startswith(LOCAL_SCHEME):
+        return _get_local(url)
+    entry = _lookup(url)
+    if entry is not None and time.time() < entry.fresh_until:
+        return entry
+    return None
+
+
+def _disk_key(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+def _disk_load(url):
+    # Read an entry back from the on-disk tier, or None if it isn't there
+    stored = _disk.load(_disk_key(url))
+    if stored is None:
+        return None
+    content, meta = stored
+    entry = LayerEntry(url, content, meta.get('etag'), meta.get('last_modified'), meta.get('fresh_until', 0.0))
+    if entry.digest != meta.get('digest'):
+        return None  # Torn or corrupted write
+    _count('disk_hits')
+    return entry
+
+
+def _disk_store(entry, body=True):
+    # Persist an entry to the on-disk tier; body=False only refreshes its validators
+    meta = {'url': entry.url, 'digest': entry.digest, 'etag': entry.etag,
+            'last_modified': entry.last_modified, 'fresh_until': entry.fresh_until}
+    try:
+        for _ in range(_disk.store(_disk_key(entry.url), entry.content if body else None, meta)):
+            _count('disk_evictions')
+    except OSError as e:
+        print(f"Error writing layer cache for {entry.url}: {e}")
+
+
+def _stale(entry, url, response):
+    # Fall back to an expired copy when the origin can't be reached or is erroring, within the allowed window
+    if response is not None:
+        print(f"Failed to fetch: {url}, Status Code: {response.status_code}")
+    if entry is None or time.time() > entry.fresh_until + LAYER_CACHE_STALE_IF_ERROR:
+        return None
+    print(f"Using stale copy of {url}")
+    _count('stale_served')
+    return entry
+
+
+def _local_path(url):
+    # The file a local:// URL names, or None when local assets are off or the path leaves the root
+    if not LOCAL_ASSET_ROOT:
+        return None
+    root = os.path.realpath(LOCAL_ASSET_ROOT)
+    path = os.path.realpath(os.path.join(root, url[len(LOCAL_SCHEME):].lstrip('/')))
+    return path if path.startswith(root + os.sep) else None
+
+
+def _get_local(url):
+    # The pinned entry for a local asset, mapping the file again if it has changed since
+    path = _local_path(url)
+    if path is None:
+        print(f"Refusing {url}: not under LOCAL_ASSET_ROOT")
+        return None
+    try:
+        info = os.stat(path)
+    except OSError as e:
+        print(f"Failed to open local asset {url}: {e}")
+        return None
+    version = (info.st_mtime_ns, info.st_size)
+    with _lock:
+        entry, mapped = _local.get(url, (None, None))
+    if mapped == version:
+        return entry
+    return _loads.do(url, _map_local, url, path, version)
+
+
+def _map_local(url, path, version):
+    # Files are read in place through the page cache; replace them (e.g. rename over) rather than rewrite them
+    try:
+        content = _map(path)
+    except (OSError, ValueError) as e:  # ValueError: an empty file can't be mapped
+        print(f"Failed to open local asset {url}: {e}")
+        return None
+    entry = LayerEntry(url, content, fresh_until=float('inf'), path=path)
+    with _lock:
+        old, _ = _local.get(url, (None, None))
+        _local[url] = (entry, version)
+    if old is not None:
+        old.release()
+    return entry
+
+
+def _cached(url):
+    # get_layer() when nothing needs downloading: the fresh entry in memory, or the local asset; else None
+    if url.startswith(LOCAL_SCHEME):
+        return _get_local(url)
+    entry = _lookup(url)
+    if entry is not None and time.time() < entry.fresh_until:
+        _count('hits')
+        return entry
+    return None
+
+
+def get_layer(url):
+    # Return the LayerEntry for a URL, downloading or revalidating only when needed.
+    # Concurrent calls for a URL that isn't fresh share one download.
+    entry = _cached(url)
+    if entry is not None or url.startswith(LOCAL_SCHEME):
+        return entry
+    return _loads.do(url, _load, url)
+
+
+def _load(url):
+    entry = _lookup(url)
+    if entry is None:
+        entry = _disk_load(url)
+        if entry is not None:
+            _remember(entry)
+
+    if entry is not None and time.time() < entry.fresh_until:
+        _count('hits')
+        return entry
+
+    headers = {}
+    if entry is not None:
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        _count('revalidations')
+
+    response, body = fetcher.get(url, headers=headers or None, inspect=_check_header)
+    if response is None or response.status_code >= 500:
+        return _stale(entry, url, response)
+
+    if response.status_code == 304 and entry is not None:
+        _count('not_modified')
+        _count('hits')
+        entry.fresh_until = time.time() + _freshness(response)
+        _disk_store(entry, body=False)
+        return entry
+
+    if response.status_code != 200:
+        print(f"Failed to fetch: {url}, Status Code: {response.status_code}")
+        return None
+
+    _count('misses')
+    entry = LayerEntry(url, body,
+                       etag=response.headers.get('ETag'),
+                       last_modified=response.headers.get('Last-Modified'),
+                       fresh_until=time.time() + _freshness(response))
+    if 'no-store' not in response.headers.get('Cache-Control', ''):
+        _remember(entry)
+        _disk_store(entry)
+    return entry
+
+
+def get_layers(urls):
+    # Fetch every non-blank URL through the cache at the same time; returns {url: LayerEntry or None}.
+    # Cache hits are answered here rather than on a download thread.
+    return fetcher.fetch_all(urls, get_layer, cached=_cached)
+
+
+def clear():
+    global _entries_bytes
+    with _lock:
+        for entry in _entries.values():
+            entry.release()
+        _entries.clear()
+        _entries_bytes = 0
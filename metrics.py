@@ -0,0 +1,172 @@
+"""Request timings and counters, exposed in the Prometheus text format.
+
+Code that does a piece of work wraps it in `with metrics.stage('decode'):`.
+Each stage is observed in a histogram and, while a request is being handled
+(see start_request()), also added to that request's timings for its
+Server-Timing header. fetcher copies the request context into its pool
+threads, so work done there is counted towards the right request.
+Metrics are per process; with several gunicorn workers, scrape each one or
+sum them.
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+PREFIX = 'image_combiner_'
+
+# Upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = (1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7, 2.5e7)
+
+_lock = threading.Lock()
+_registry = []
+_timings = contextvars.ContextVar('timings', default=None)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = PREFIX + name, help, labels
+        self.values = {}  # label values -> count
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def lines(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        for key, value in sorted(self.values.items()):
+            yield f'{self.name}{_labels(self.labels, key)} {value}'
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=SECONDS_BUCKETS, labels=()):
+        self.name, self.help, self.buckets, self.labels = PREFIX + name, help, buckets, labels
+        self.values = {}  # label values -> [count per bucket..., sum, count]
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with _lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def lines(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        for key, series in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, series):
+                yield f'{self.name}_bucket{_labels(self.labels + ("le",), key + (f"{bound:g}",))} {count}'
+            yield f'{self.name}_bucket{_labels(self.labels + ("le",), key + ("+Inf",))} {series[-1]}'
+            yield f'{self.name}_sum{_labels(self.labels, key)} {series[-2]:.6f}'
+            yield f'{self.name}_count{_labels(self.labels, key)} {series[-1]}'
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = (f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUESTS = Counter('requests_total', 'Finished /combine-images requests by HTTP status', ('status',))
+REQUEST_SECONDS = Histogram('request_seconds', 'Time to answer a /combine-images request')
+STAGE_SECONDS = Histogram('stage_seconds', 'Time spent in each render stage', labels=('stage',))
+FETCH_SECONDS = Histogram('fetch_seconds', 'Time to download one URL, by outcome', labels=('outcome',))
+RESPONSE_BYTES = Histogram('response_bytes', 'Size of rendered responses', buckets=BYTES_BUCKETS)
+FETCH_FAILURES = Counter('fetch_failures_total', 'Downloads that failed', ('reason',))
+HEDGES = Counter('hedged_fetches_total', 'Duplicate requests sent because a download was slow')
+SKIPPED_LAYERS = Counter('skipped_layers_total', 'Layers left out of a render', ('reason',))
+ADMISSION_WAIT_SECONDS = Histogram('admission_wait_seconds', 'Time renders waited for capacity to start')
+ADMISSION_REJECTED = Counter('admission_rejected_total', 'Renders turned away with a 429', ('reason',))
+COALESCED = Counter('coalesced_total', 'Calls that waited for an identical one already in flight', ('kind',))
+
+
+def start_request():
+    # Begin collecting stage timings for the current request; returns them for server_timing()
+    timings = {'stages': {}, 'fetches': [], 'start': time.perf_counter()}
+    _timings.set(timings)
+    return timings
+
+
+def finish_request(timings, status, size=None):
+    # Count a finished request; size is the body length when it is known up front
+    REQUESTS.inc(status=status)
+    REQUEST_SECONDS.observe(time.perf_counter() - timings['start'])
+    if size is not None:
+        RESPONSE_BYTES.observe(size)
+
+
+def copy_context():
+    # Snapshot of the current context, for running work on another thread on the request's behalf
+    return contextvars.copy_context()
+
+
+def _add(name, seconds):
+    timings = _timings.get()
+    if timings is not None:
+        with _lock:
+            timings['stages'][name] = timings['stages'].get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name):
+    # Time a block of work as the named stage
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def record(name, seconds):
+    # Count a stage that was timed elsewhere (e.g. in a worker process)
+    STAGE_SECONDS.observe(seconds, stage=name)
+    _add(name, seconds)
+
+
+def record_fetch(url, seconds, outcome):
+    # One download: 'ok', or why it failed ('network', 'status', 'rejected', 'circuit_open' or 'slot_timeout')
+    FETCH_SECONDS.observe(seconds, outcome=outcome)
+    if outcome != 'ok':
+        FETCH_FAILURES.inc(reason=outcome)
+    _add('fetch', seconds)
+    timings = _timings.get()
+    if timings is not None:
+        with _lock:
+            timings['fetches'].append((url, seconds))
+
+
+def server_timing(timings, extra=()):
+    # Build a Server-Timing header value: every stage, each download, then the total so far
+    entries = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in timings['stages'].items()]
+    for index, (url, seconds) in enumerate(timings['fetches']):
+        entries.append(f'fetch-{index};desc="{_escape(url)}";dur={seconds * 1000:.1f}')
+    entries.extend(extra)
+    entries.append(f"total;dur={(time.perf_counter() - timings['start']) * 1000:.1f}")
+    return ', '.join(entries)
+
+
+def exposition(gauges=None):
+    # All metrics in the Prometheus text format; gauges is {group: {name: value}} for cache statistics and the like
+    with _lock:
+        lines = [line for metric in _registry for line in metric.lines()]
+    for group, values in (gauges or {}).items():
+        for name, value in sorted(values.items()):
+            metric = f'{PREFIX}{group}_{name}'
+            lines.append(f'# TYPE {metric} gauge')
+            lines.append(f'{metric} {value}')
+    return '\n'.join(lines) + '\n'
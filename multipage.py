@@ -0,0 +1,155 @@
+"""Multi-page PDF and animated GIF/WebP output, written one page at a time.
+
+Each writer takes an iterator of (canvas, duration in ms) and yields the
+output in pieces, so only one page's pixels are in memory at once. Pages are
+encoded on their own and then wrapped in the container by hand, because
+Pillow's save_all wants every frame up front.
+"""
+import struct
+import tempfile
+
+from PIL import Image
+
+import encoder
+
+FORMATS = ('pdf', 'gif', 'webp')
+# Longest frame duration in ms each animated format can store (GIF: 16 bits of 1/100 s, WebP: 24 bits of ms)
+MAX_DURATION = {'gif': 655350, 'webp': 0xffffff}
+CHUNK_SIZE = 64 * 1024
+
+
+def stream(output_format, pages, options=None, loop=0):
+    # Yield the bytes of a multi-page document in the given format; loop is the animation repeat count (0 = forever)
+    if output_format == 'pdf':
+        return _stream_pdf(pages, options or {})
+    if output_format == 'gif':
+        return _stream_gif(pages, options or {}, loop)
+    if output_format == 'webp':
+        return _stream_webp(pages, options or {}, loop)
+    raise ValueError(f'Multi-page output must be one of {", ".join(FORMATS)}')
+
+
+def _stream_pdf(pages, options):
+    # Each page is one full-bleed JPEG image at 72 dpi, like Pillow's own PDF output.
+    # Objects: 1 catalog, 2 page tree (written last, once every page is known), then 3 per page.
+    offsets = {}
+    written = 0
+    kids = []
+
+    def emit(number, body):
+        nonlocal written
+        offsets[number] = written
+        data = b'%d 0 obj\n' % number + body + b'\nendobj\n'
+        written += len(data)
+        return data
+
+    header = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+    written = len(header)
+    yield header
+    yield emit(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+
+    for index, (canvas, _) in enumerate(pages):
+        page, image, contents = 3 + 3 * index, 4 + 3 * index, 5 + 3 * index
+        kids.append(page)
+        width, height = canvas.size
+        jpeg, _ = encoder.encode(canvas, 'jpeg', options)
+        yield emit(page, b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] '
+                         b'/Resources << /XObject << /Im0 %d 0 R >> /ProcSet [/PDF /ImageC] >> '
+                         b'/Contents %d 0 R >>' % (width, height, image, contents))
+        yield emit(image, b'<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceRGB '
+                          b'/BitsPerComponent 8 /Filter /DCTDecode /Length %d >>\nstream\n' % (width, height, len(jpeg))
+                   + jpeg + b'\nendstream')
+        draw = b'q %d 0 0 %d 0 0 cm /Im0 Do Q' % (width, height)
+        yield emit(contents, b'<< /Length %d >>\nstream\n' % len(draw) + draw + b'\nendstream')
+
+    yield emit(2, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (b' '.join(b'%d 0 R' % kid for kid in kids), len(kids)))
+
+    xref = written
+    count = max(offsets) + 1
+    yield (b'xref\n0 %d\n0000000000 65535 f \n' % count
+           + b''.join(b'%010d 00000 n \n' % offsets[number] for number in range(1, count))
+           + b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (count, xref))
+
+
+def _gif_blocks(data, pos):
+    # Skip a run of GIF data sub-blocks starting at pos; returns the position after the terminator
+    while data[pos]:
+        pos += data[pos] + 1
+    return pos + 1
+
+
+def _gif_frame(canvas, options):
+    # Encode one canvas as a single-frame GIF and return (image descriptor with local colour table, image data)
+    data, _ = encoder.encode(canvas, 'gif', options)
+
+    screen_flags = data[10]
+    palette_end = 13 + (3 << ((screen_flags & 7) + 1) if screen_flags & 0x80 else 0)
+    palette = data[13:palette_end]
+    pos = palette_end
+    while data[pos] == 0x21:  # Drop the frame's own extensions
+        pos = _gif_blocks(data, pos + 2)
+    descriptor = bytearray(data[pos:pos + 10])
+    if palette:
+        # Move the global colour table into the frame, so every frame keeps its own palette
+        descriptor[9] = (descriptor[9] & 0x40) | 0x80 | (screen_flags & 7)
+    start = pos + 10
+    end = _gif_blocks(data, start + 1)  # LZW minimum code size, then the data sub-blocks
+    return bytes(descriptor) + palette, data[start:end]
+
+
+def _stream_gif(pages, options, loop):
+    size = None
+    for canvas, duration in pages:
+        if size is None:
+            size = canvas.size
+            # Logical screen with no global colour table, then the looping extension
+            yield (b'GIF89a' + struct.pack('<HHBBB', size[0], size[1], 0x70, 0, 0)
+                   + b'\x21\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H', loop) + b'\x00')
+        elif canvas.size != size:
+            canvas = canvas.resize(size, Image.LANCZOS)
+        descriptor, image = _gif_frame(canvas, options)
+        # Graphic control extension: keep the frame on screen for its duration (GIF counts in 1/100 s)
+        control = b'\x21\xf9\x04' + struct.pack('<BHBB', 1 << 2, round(duration / 10), 0, 0)
+        yield control + descriptor + image
+    yield b'\x3b'
+
+
+def _webp_chunk(fourcc, payload):
+    return fourcc + struct.pack('<I', len(payload)) + payload + (b'\x00' if len(payload) % 2 else b'')
+
+
+def _stream_webp(pages, options, loop):
+    # The RIFF header holds the total size, so frames are encoded into a temporary file first
+    # (compressed, so memory stays flat) and the file is streamed once the size is known
+    size = None
+    with tempfile.TemporaryFile() as frames:
+        for canvas, duration in pages:
+            if size is None:
+                size = canvas.size
+            elif canvas.size != size:
+                canvas = canvas.resize(size, Image.LANCZOS)
+            data, _ = encoder.encode(canvas, 'webp', options)
+            # Keep the bitstream chunks (ALPH, VP8 or VP8L) of the single-frame file
+            bitstream, pos = [], 12
+            while pos < len(data):
+                fourcc, length = data[pos:pos + 4], struct.unpack('<I', data[pos + 4:pos + 8])[0]
+                if fourcc in (b'ALPH', b'VP8 ', b'VP8L'):
+                    bitstream.append(data[pos:pos + 8 + length + length % 2])
+                pos += 8 + length + length % 2
+            # Frame at (0, 0), full size; don't blend with the previous frame
+            header = struct.pack('<I', 0)[:3] * 2 + struct.pack('<I', size[0] - 1)[:3] + struct.pack('<I', size[1] - 1)[:3]
+            header += struct.pack('<I', duration)[:3] + b'\x02'
+            frames.write(_webp_chunk(b'ANMF', header + b''.join(bitstream)))
+
+        if size is None:
+            return
+        chunks = (_webp_chunk(b'VP8X', b'\x02\x00\x00\x00' + struct.pack('<I', size[0] - 1)[:3]
+                              + struct.pack('<I', size[1] - 1)[:3])
+                  + _webp_chunk(b'ANIM', b'\xff\xff\xff\xff' + struct.pack('<H', loop)))
+        yield b'RIFF' + struct.pack('<I', 4 + len(chunks) + frames.tell()) + b'WEBP' + chunks
+        frames.seek(0)
+        while True:
+            data = frames.read(CHUNK_SIZE)
+            if not data:
+                break
+            yield data
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import disk_tier
+import layer_cache
+
+# Rendered-output cache sizing (override with environment variables)
+OUTPUT_CACHE_MAX_BYTES = int(os.environ.get('OUTPUT_CACHE_MAX_BYTES', 256 * 1024 * 1024))  # Memory tier budget
+OUTPUT_CACHE_DIR = os.environ.get('OUTPUT_CACHE_DIR')  # Optional on-disk tier; disabled when unset
+OUTPUT_CACHE_DISK_MAX_BYTES = int(os.environ.get('OUTPUT_CACHE_DISK_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+
+_disk = disk_tier.DiskTier(OUTPUT_CACHE_DIR, OUTPUT_CACHE_DISK_MAX_BYTES)
+_entries = OrderedDict()  # key -> (body, mime type, etag), least recently used first
+_entries_bytes = 0
+_lock = threading.Lock()
+
+stats = {'hits': 0, 'misses': 0, 'not_modified': 0, 'evictions': 0, 'disk_hits': 0, 'uncacheable': 0}
+
+
+def _count(name):
+    with _lock:
+        stats[name] += 1
+
+
+def count_not_modified():
+    _count('not_modified')
+
+
+def get_stats():
+    with _lock:
+        return dict(stats, entries=len(_entries), bytes=_entries_bytes, max_bytes=OUTPUT_CACHE_MAX_BYTES)
+
+
+def etag_for(body):
+    # Strong validator for a response body
+    return '"' + hashlib.sha256(body).hexdigest()[:40] + '"'
+
+
+def _hash(options, layers, **extra):
+    canonical = {
+        'specs': options['specs'],
+        'layers': layers,
+        'text_blocks': options['text_blocks'],
+        'target_box': options['target_box'],
+        'format': options['format'],
+        'encode': options['encode'],
+        **extra,
+    }
+    encoded = json.dumps(canonical, sort_keys=True, separators=(',', ':'), default=list)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def request_key(options):
+    """Canonical hash of a parsed request plus the current content of its layers.
+
+    Returns None when any layer isn't fresh in the layer cache, since then the
+    output can't be known without going back to the origin.
+    """
+    layers = []
+    for url in options['urls']:
+        if not url.strip():
+            layers.append(None)  # Blank URLs are skipped, but their position still matters
+            continue
+        entry = layer_cache.peek(url)
+        if entry is None:
+            return None
+        layers.append(entry.digest)
+    return _hash(options, layers)
+
+
+def render_key(options):
+    # Canonical hash of a parsed request alone, for spotting identical renders that are in flight at the same time.
+    # Unlike the cache key it covers "stream", since that decides whether the render hands back bytes or a Stream.
+    return _hash(options, None, stream=options.get('stream'))
+
+
+def get(key):
+    # Return (body, mime type, etag) for a key, or None
+    with _lock:
+        hit = _entries.get(key)
+        if hit is not None:
+            _entries.move_to_end(key)
+            stats['hits'] += 1
+            return hit
+    hit = _disk_load(key)
+    if hit is not None:
+        _count('disk_hits')
+        _count('hits')
+        _remember(key, hit)
+        return hit
+    _count('misses')
+    return None
+
+
+def put(key, body, mime_type):
+    # Cache a rendered response; returns its etag
+    etag = etag_for(body)
+    if key is None:
+        _count('uncacheable')
+        return etag
+    _remember(key, (body, mime_type, etag))
+    _disk_store(key, body, mime_type, etag)
+    return etag
+
+
+def _remember(key, value):
+    global _entries_bytes
+    size = len(value[0])
+    if size > OUTPUT_CACHE_MAX_BYTES:
+        return
+    with _lock:
+        old = _entries.pop(key, None)
+        if old is not None:
+            _entries_bytes -= len(old[0])
+        _entries[key] = value
+        _entries_bytes += size
+        while _entries_bytes > OUTPUT_CACHE_MAX_BYTES:
+            _, evicted = _entries.popitem(last=False)
+            _entries_bytes -= len(evicted[0])
+            stats['evictions'] += 1
+
+
+def _disk_load(key):
+    stored = _disk.load(key)
+    if stored is None:
+        return None
+    body, meta = stored
+    if etag_for(body) != meta.get('etag'):
+        return None  # Torn or corrupted write
+    return body, meta['mime_type'], meta['etag']
+
+
+def _disk_store(key, body, mime_type, etag):
+    try:
+        _disk.store(key, body, {'mime_type': mime_type, 'etag': etag})
+    except OSError as e:
+        print(f"Error writing output cache for {key}: {e}")
+
+
+def clear():
+    # Drop the memory tier (the disk tier is left alone)
+    global _entries_bytes
+    with _lock:
+        _entries.clear()
+        _entries_bytes = 0
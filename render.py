@@ -0,0 +1,533 @@
+import os
+
+import compositor
+import encoder
+import fetcher
+import font_cache
+import layer_cache
+import metrics
+import multipage
+import singleflight
+import templates
+import text_layout
+
+WHITE = (255, 255, 255, 255)
+
+# Most pages (or frames) one multi-page request may describe
+MAX_PAGES = int(os.environ.get('MAX_PAGES', 500))
+STREAM_MIN_PIXELS = int(os.environ.get('STREAM_MIN_PIXELS', 4_000_000))  # Outputs this big are sent while encoding
+
+_precompositions = singleflight.Group('template')
+
+
+class RenderError(Exception):
+    # A problem with the request itself; reported to the client with the given HTTP status
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+    def __reduce__(self):
+        # Keep the status when the error crosses a process boundary
+        return RenderError, (str(self), self.status)
+
+
+def _layer_spec(entry):
+    # Normalise one "images" entry (a URL string or a placement object) into a dict
+    if not isinstance(entry, dict):
+        entry = {'url': entry}
+    spec = {
+        'url': entry.get('url') or '',
+        'anchor': entry.get('anchor', 'top-left'),  # Which point of the canvas the layer lines up with
+        'offset': entry.get('offset', (0, 0)),  # Pixels to move the layer by after anchoring
+        'fit': entry.get('fit', 'none'),  # none, contain, cover or stretch to the canvas size
+    }
+    if spec['anchor'] not in compositor.ANCHORS:
+        raise RenderError(f"Unknown anchor '{spec['anchor']}' for {spec['url']}")
+    if spec['fit'] not in compositor.FITS:
+        raise RenderError(f"Unknown fit '{spec['fit']}' for {spec['url']}")
+    offset = spec['offset']
+    if (not isinstance(offset, (list, tuple)) or len(offset) != 2
+            or not all(isinstance(value, int) and not isinstance(value, bool) for value in offset)):
+        raise RenderError(f"'offset' of {spec['url']} must be [x, y] in whole pixels")
+    spec['offset'] = tuple(offset)
+    if 'width' in entry or 'height' in entry:
+        # Declared source size, used to price the request before the layer is downloaded
+        size = (entry.get('width'), entry.get('height'))
+        if not all(isinstance(value, int) and not isinstance(value, bool) and value > 0 for value in size):
+            raise RenderError(f"'width' and 'height' of {spec['url']} must both be positive whole numbers of pixels")
+        spec['size'] = size
+    return spec
+
+
+def _target_box(data):
+    # The (width, height) box the output must fit in, from max_size/width/height, or None for full size
+    limits = {}
+    for name in ('max_size', 'width', 'height'):
+        value = data.get(name)
+        if value is None:
+            continue
+        if not isinstance(value, int) or isinstance(value, bool) or value <= 0:
+            raise RenderError(f"'{name}' must be a positive whole number of pixels")
+        limits[name] = value
+    if not limits:
+        return None
+    max_size = limits.get('max_size', float('inf'))
+    return min(limits.get('width', max_size), max_size), min(limits.get('height', max_size), max_size)
+
+
+def _scaled(size, scale):
+    # Scale a (width, height) pair, keeping it at least 1px
+    if scale == 1.0:
+        return tuple(size)
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def _encode_options(data):
+    try:
+        return encoder.parse_options(data.get('encode'))
+    except ValueError as e:
+        raise RenderError(str(e))
+
+
+def _text_blocks(data):
+    # The text blocks to draw, in order. Without "text_blocks", the legacy fields describe a single
+    # block, which is skipped when "font" is "No" (the default) or there is no text.
+    entries = data.get('text_blocks')
+    if entries is None:
+        if data.get('font', "No") == "No" or not data.get('text'):
+            return []
+        entries = [{'text': data['text']}]
+    elif not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+        raise RenderError("'text_blocks' must be a list of JSON objects")
+    # The top-level font settings are defaults for every block
+    defaults = {name: data[name] for name in ('font_url', 'font_size', 'text_position') if name in data}
+    blocks = []
+    for index, entry in enumerate(entries):
+        try:
+            blocks.append(text_layout.parse_block(entry, defaults))
+        except ValueError as e:
+            raise RenderError(f'Text block {index}: {e}')
+    return [block for block in blocks if block['text']]
+
+
+def parse_request(data):
+    # Pull the rendering options out of a /combine-images payload
+    if not isinstance(data, dict):
+        raise RenderError('Request body must be a JSON object')
+    template_id, static_layers = data.get('template_id'), 0
+    if template_id is not None:
+        try:
+            data, static_layers = templates.expand(data)
+        except KeyError:
+            raise RenderError(f"Unknown template '{template_id}'", 404)
+    # List of image URLs, or {"url", "anchor", "offset", "fit"} objects to place a layer
+    specs = [_layer_spec(entry) for entry in data.get('images', [])]
+    options = {
+        'specs': specs,
+        'urls': [spec['url'] for spec in specs],
+        'text_blocks': _text_blocks(data),  # Text drawn over the layers; see text_layout.parse_block()
+        'target_box': _target_box(data),  # Largest (width, height) the output may be, or None
+        'format': data.get('format', 'png').lower(),  # Default to PNG; "auto" picks the smallest
+        'encode': _encode_options(data),  # Quality, compression and similar encoder settings
+        'template_id': template_id,
+        'static_layers': static_layers,  # How many leading layers come from the template
+        'stream': data.get('stream'),  # Send the output while it is encoded; None decides by size
+    }
+    if not options['urls']:
+        raise RenderError('No images provided in the request')
+    if options['stream'] is not None and not isinstance(options['stream'], bool):
+        raise RenderError("'stream' must be true or false")
+    if options['format'] in encoder.MIME_TYPES and not encoder.available(options['format']):
+        raise RenderError(f"{options['format'].upper()} output is not available on this server")
+    return options
+
+
+def inline_templates(data):
+    # The payload with each template_id replaced by the template's fields, for rendering in a process that
+    # can't see this one's template registry. Call after parse_request()/parse_pages() has accepted it.
+    if not isinstance(data, dict):
+        return data
+    if isinstance(data.get('pages'), list):
+        # Pages inherit the top-level fields, so a top-level template is expanded into each page
+        defaults = {name: value for name, value in data.items() if name not in ('pages', 'async')}
+        pages = [inline_templates(dict(defaults, **page)) if isinstance(page, dict) else page for page in data['pages']]
+        return dict({name: value for name, value in data.items() if name != 'template_id'}, pages=pages)
+    if data.get('template_id') is None:
+        return data
+    try:
+        return templates.expand(data)[0]
+    except KeyError:
+        raise RenderError(f"Unknown template '{data['template_id']}'", 404)
+
+
+def font_urls(options):
+    # Every font file the text blocks need, once each
+    return list(dict.fromkeys(block['font_url'] for block in options['text_blocks'] if block['font_url']))
+
+
+def start_font_fetch(options, futures=None):
+    # Start the font downloads so they run alongside the image downloads; returns {font_url: future}.
+    # Pass futures to share downloads between several requests.
+    futures = {} if futures is None else futures
+    for url in font_urls(options):
+        if url not in futures:
+            futures[url] = fetcher.submit(url, font_cache.get_font_bytes, cached=font_cache.cached_bytes)
+    return futures
+
+
+def fetch_fonts(options, futures):
+    # Wait for the font downloads started earlier (instant once cached); returns {font_url: bytes}
+    fonts = {}
+    for url in font_urls(options):
+        fonts[url] = futures[url].result()
+        if not fonts[url]:
+            raise RenderError(f'Failed to fetch font from URL: {url}')
+    return fonts
+
+
+def plan_stack(options, layers):
+    """Work out the canvas and where every layer goes, without decoding any pixels.
+
+    Returns (canvas_size, scale, plan) where plan is a list of
+    (key, layer, size, (x, y)) in drawing order, base image first. Equal keys
+    mean the same pixels at the same place, which lets callers share work
+    between requests.
+    """
+    target_box = options['target_box']
+
+    # The first image that downloads (and hasn't failed to decode) determines the
+    # canvas size, scaled down to fit the requested output size (never up)
+    base = None
+    for url in options['urls']:
+        layer = layers.get(url)
+        if not layer:  # Skip empty, blank or failed URLs
+            continue
+        if not layer.error:
+            base = layer
+            break
+        print(f"Error decoding base image from {url}: {layer.error}")
+
+    if base is None:
+        raise RenderError('No valid base image found')
+
+    scale = 1.0
+    if target_box:
+        scale = min(1.0, target_box[0] / base.source_size[0], target_box[1] / base.source_size[1])
+    canvas_size = _scaled(base.source_size, scale)
+    plan = [((base.url, canvas_size, (0, 0)), base, canvas_size, (0, 0))]
+
+    # Each subsequent image is drawn at its fitted size, in the order they were given
+    for spec in options['specs'][1:]:
+        layer = layers.get(spec['url'])
+        if not layer:  # Skip empty, blank or failed URLs
+            continue
+        if layer.error:
+            print(f"Error applying overlay image from {spec['url']}: {layer.error}")
+            continue
+        size = compositor.fitted_size(_scaled(layer.source_size, scale), canvas_size, spec['fit'])
+        offset = (round(spec['offset'][0] * scale), round(spec['offset'][1] * scale))
+        position = compositor.position(size, canvas_size, spec['anchor'], offset)
+        plan.append(((spec['url'], size, position), layer, size, position))
+    return canvas_size, scale, plan
+
+
+def template_prefix(options, layers, plan):
+    """The template's static layers at the start of a plan, composited once and cached.
+
+    Returns (depth, key, pixels, shared buffer path), where depth is how many
+    plan entries the pixels stand in for, or None when there is nothing to
+    reuse (no template, fewer than two static layers, or a static layer that
+    is missing from the plan).
+    """
+    static = options['static_layers']
+    if static < 2:
+        return None
+    static_options = {'specs': options['specs'][:static], 'urls': options['urls'][:static],
+                      'target_box': options['target_box']}
+    try:
+        canvas_size, _, static_plan = plan_stack(static_options, layers)
+    except RenderError:
+        return None
+    depth = len(static_plan)
+    if depth < 2 or [entry[0] for entry in plan[:depth]] != [entry[0] for entry in static_plan]:
+        return None
+
+    # Keyed by the layers' content too, so a changed layer is composited again
+    key = (options['template_id'],) + tuple((entry[0], entry[1].digest) for entry in static_plan)
+    hit = templates.get_prefix(key) or _precompositions.do(key, _precompose, key, static_plan, canvas_size)
+    if hit is None:
+        return None
+    return (depth, key) + tuple(hit)
+
+
+def _precompose(key, static_plan, canvas_size):
+    # Composite a template's static layers and keep the result; None if one of them can't be decoded
+    decoding = [(fetcher.run(layer.decoded, size), layer, size, position) for _, layer, size, position in static_plan]
+    try:
+        placed = [(pixels.result(), position, layer.coverage(size)) for pixels, layer, size, position in decoding]
+    except Exception:
+        return None  # decoded() recorded the error; the caller plans without that layer
+    with metrics.stage('composite'):
+        pixels = compositor.composite_pixels(placed, canvas_size, background=WHITE)
+    return templates.put_prefix(key, pixels)
+
+
+def build_stack(options, layers):
+    """Decode and place the layers of one request.
+
+    Returns (canvas_size, scale, stack) where stack is a list of
+    (key, (pixels, (x, y), coverage)) in drawing order; see plan_stack() for
+    the keys and compositor.Coverage for the last item. A template's static
+    layers come as one precomposited entry.
+    """
+    while True:
+        canvas_size, scale, plan = plan_stack(options, layers)
+        prefix = template_prefix(options, layers, plan)
+        if prefix is not None:
+            depth, key, pixels, _ = prefix
+            stack = [(key, (pixels, (0, 0), compositor.Coverage.solid(pixels.shape)))]
+            break
+        try:
+            base = plan[0][1]
+            stack = [(plan[0][0], (base.decoded(canvas_size), (0, 0), base.coverage(canvas_size)))]
+            depth = 1
+            break
+        except Exception:
+            pass  # decoded() recorded the error, so the next plan picks another base
+
+    # Decode (and measure) each subsequent image at the size it will be drawn, all at the same time
+    decoding = [(key, layer, fetcher.run(layer.coverage, size), size, position)
+                for key, layer, size, position in plan[depth:]]
+
+    for key, layer, coverage, size, position in decoding:
+        try:
+            coverage = coverage.result()
+            stack.append((key, (layer.decoded(size), position, coverage)))
+        except Exception as e:
+            print(f"Error applying overlay image from {layer.url}: {e}")
+    count_skipped(options, layers)
+    return canvas_size, scale, stack
+
+
+def prepare_template(template_id):
+    # Fetch a template's layers and composite its static part at its own output size, ahead of the first request
+    options = parse_request({'template_id': template_id})
+    layers = layer_cache.get_layers(options['urls'])
+    canvas_size, _, plan = plan_stack(options, layers)
+    prefix = template_prefix(options, layers, plan)
+    return {'template_id': template_id, 'layers': len(options['urls']), 'canvas_size': list(canvas_size),
+            'precomposited': prefix[0] if prefix else 0}
+
+
+def count_skipped(options, layers):
+    # Record every layer that was left out of the render, and why
+    for url in options['urls']:
+        if not url.strip():
+            continue
+        layer = layers.get(url)
+        if layer is None:
+            metrics.SKIPPED_LAYERS.inc(reason='fetch_failed')
+        elif layer.error:
+            metrics.SKIPPED_LAYERS.inc(reason='decode_error')
+
+
+def draw_text(canvas, options, scale, fonts):
+    # Draw every text block, shrunk along with the image when a smaller output was requested
+    if not options['text_blocks']:
+        return
+    with metrics.stage('text'):
+        for block in options['text_blocks']:
+            try:
+                text_layout.draw(canvas, block, scale, fonts)
+            except text_layout.FontError as e:
+                raise RenderError(f'Failed to load font: {e}')
+
+
+def _streams(options, canvas):
+    # Whether to send the output as it is encoded: when asked to, or by default for big outputs.
+    # Only some formats can be (see encoder.STREAMABLE); "auto" has to encode every candidate first.
+    if options['format'] not in encoder.STREAMABLE:
+        return False
+    if options['stream'] is not None:
+        return options['stream']
+    return canvas.size[0] * canvas.size[1] >= STREAM_MIN_PIXELS
+
+
+def finish(options, canvas, scale, font_futures, stream=False):
+    """Draw the text and encode the final image; returns (bytes, mime type).
+
+    With stream, a big enough output (see _streams()) is returned as an
+    encoder.Stream that is still being written instead of bytes.
+    """
+    draw_text(canvas, options, scale, fetch_fonts(options, font_futures))
+    if stream and _streams(options, canvas):
+        output = encoder.Stream(canvas, options['format'], options['encode'])
+        print(f"Final image streaming as {output.mime_type}")
+        return output, output.mime_type
+    body, mime_type = encoder.encode(canvas, options['format'], options['encode'])
+    print(f"Final image encoded as {mime_type}, {len(body)} bytes")
+    return body, mime_type
+
+
+def render(data, stream=False):
+    # Run the whole pipeline for one /combine-images payload; returns (bytes or encoder.Stream, mime type)
+    if isinstance(data, dict) and 'pages' in data:
+        chunks, mime_type = render_pages(data)
+        return b''.join(chunks), mime_type
+    options = parse_request(data)
+    font_futures = start_font_fetch(options)
+
+    # Fetch every layer at the same time through the layer cache; results are keyed by URL
+    layers = layer_cache.get_layers(options['urls'])
+    canvas_size, scale, stack = build_stack(options, layers)
+
+    # Blend the whole stack over a white background in one pass
+    with metrics.stage('composite'):
+        canvas = compositor.composite([placed for _, placed in stack], canvas_size, background=WHITE)
+    return finish(options, canvas, scale, font_futures, stream)
+
+
+def _shared_prefix(stacks):
+    # How many leading layers every stack in the list has in common
+    length = min(len(stack) for stack in stacks)
+    for index in range(length):
+        key = stacks[0][index][0]
+        if any(stack[index][0] != key for stack in stacks[1:]):
+            return index
+    return length
+
+
+def render_batch(items, defaults=None):
+    """Render many /combine-images payloads in one go.
+
+    Layers and fonts are fetched once for the whole batch. Items whose stacks
+    start with the same layers are grouped, that shared prefix is composited
+    once, and each item is finished from a copy of it. Returns one result per
+    item: {'status', 'body', 'mime_type'} or {'status', 'error'}. A bad item
+    never fails the others.
+    """
+    results = [None] * len(items)
+    jobs = []  # (index, options)
+    font_futures = {}  # Shared by the whole batch, so every font is fetched once
+    for index, item in enumerate(items):
+        try:
+            data = dict(defaults or {}, **item) if isinstance(item, dict) else item
+            options = parse_request(data)
+            start_font_fetch(options, font_futures)
+            jobs.append((index, options))
+        except RenderError as e:
+            results[index] = {'status': e.status, 'error': str(e)}
+
+    # Every distinct layer URL in the batch is fetched once, all at the same time
+    all_urls = [url for _, options in jobs for url in options['urls']]
+    layers = layer_cache.get_layers(all_urls)
+
+    # Work out each item's stack, then group items by canvas size and base layer
+    groups = {}
+    for index, options in jobs:
+        try:
+            canvas_size, scale, stack = build_stack(options, layers)
+        except RenderError as e:
+            results[index] = {'status': e.status, 'error': str(e)}
+            continue
+        groups.setdefault(stack[0][0], []).append((index, options, canvas_size, scale, stack))
+
+    for members in groups.values():
+        canvas_size = members[0][2]
+        shared = _shared_prefix([member[4] for member in members])
+        prefix = None
+        if len(members) > 1:
+            print(f"Compositing {shared} shared layers once for {len(members)} items")
+            with metrics.stage('composite'):
+                prefix = compositor.composite_pixels([placed for _, placed in members[0][4][:shared]],
+                                                     canvas_size, background=WHITE)
+        else:
+            shared = 0
+
+        for index, options, _, scale, stack in members:
+            try:
+                with metrics.stage('composite'):
+                    canvas = compositor.composite([placed for _, placed in stack[shared:]],
+                                                  canvas_size, background=WHITE, start=prefix)
+                body, mime_type = finish(options, canvas, scale, font_futures)
+                results[index] = {'status': 200, 'body': body, 'mime_type': mime_type}
+            except RenderError as e:
+                results[index] = {'status': e.status, 'error': str(e)}
+            except Exception as e:
+                print(f"Error rendering batch item {index}: {e}")
+                results[index] = {'status': 500, 'error': str(e)}
+    return results
+
+
+def parse_pages(data):
+    # Validate a multi-page payload; returns (format, loop, [(options, duration in ms)]) without fetching anything
+    pages = data.get('pages')
+    if not isinstance(pages, list) or not pages:
+        raise RenderError('No pages provided in the request')
+    if len(pages) > MAX_PAGES:
+        raise RenderError(f'A request may contain at most {MAX_PAGES} pages')
+    output_format = str(data.get('format', 'pdf')).lower()
+    if output_format not in multipage.FORMATS:
+        raise RenderError(f'Multi-page output must be one of {", ".join(multipage.FORMATS)}')
+    loop = data.get('loop', 0)
+    if not isinstance(loop, int) or isinstance(loop, bool) or not 0 <= loop <= 0xffff:
+        raise RenderError("'loop' must be a whole number from 0 (forever) to 65535")
+
+    # The other top-level fields are defaults for every page
+    defaults = {name: value for name, value in data.items() if name not in ('pages', 'async')}
+    page_options = []
+    for index, page in enumerate(pages):
+        if not isinstance(page, dict):
+            raise RenderError(f'Page {index} must be a JSON object')
+        try:
+            options = parse_request(dict(defaults, **page))
+        except RenderError as e:
+            raise RenderError(f'Page {index}: {e}', e.status)
+        duration = page.get('duration', data.get('duration', 500))  # How long an animation frame shows
+        if not isinstance(duration, int) or isinstance(duration, bool) or duration < 0:
+            raise RenderError(f"'duration' of page {index} must be a whole number of milliseconds")
+        if duration > multipage.MAX_DURATION.get(output_format, duration):
+            raise RenderError(f"'duration' of page {index} must be at most "
+                              f"{multipage.MAX_DURATION[output_format]} ms for {output_format.upper()}")
+        page_options.append((options, duration))
+    return output_format, loop, page_options
+
+
+def render_pages(data):
+    """Render a multi-page payload into one PDF, GIF or WebP document.
+
+    Every entry of data['pages'] is a /combine-images payload, with the other
+    top-level fields as defaults. Returns (chunks, mime type) where chunks is
+    a generator yielding the document a page at a time. Problems that can be
+    spotted up front (bad pages, missing base images, fonts that don't
+    download) raise RenderError before anything is yielded.
+    """
+    output_format, loop, page_options = parse_pages(data)
+
+    # Every layer and font is fetched once for the whole document, all at the same time
+    font_futures = {}
+    for options, _ in page_options:
+        start_font_fetch(options, font_futures)
+    layers = layer_cache.get_layers([url for options, _ in page_options for url in options['urls']])
+    for index, (options, _) in enumerate(page_options):
+        try:
+            plan_stack(options, layers)
+        except RenderError as e:
+            raise RenderError(f'Page {index}: {e}', e.status)
+        try:
+            fetch_fonts(options, font_futures)
+        except RenderError as e:
+            raise RenderError(f'Page {index}: {e}', e.status)
+
+    def canvases():
+        # Decoded layers stay in the layer cache, so pages that share them only decode them once
+        for options, duration in page_options:
+            canvas_size, scale, stack = build_stack(options, layers)
+            with metrics.stage('composite'):
+                canvas = compositor.composite([placed for _, placed in stack], canvas_size, background=WHITE)
+            draw_text(canvas, options, scale, fetch_fonts(options, font_futures))
+            yield canvas, duration
+
+    print(f"Streaming {len(page_options)} pages as {output_format}")
+    chunks = multipage.stream(output_format, canvases(), _encode_options(data), loop)
+    return chunks, encoder.MIME_TYPES[output_format]
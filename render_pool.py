@@ -0,0 +1,127 @@
+import os
+
+import compositor
+import encoder
+import layer_cache
+import metrics
+import render
+import shared_pixels
+import worker_pool
+
+# "threads" renders on the request thread; "processes" hands decode/composite/encode to worker processes
+RENDER_BACKEND = os.environ.get('RENDER_BACKEND', 'threads')
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', worker_pool.default_workers()))  # Per web worker
+
+_pool = worker_pool.WorkerPool(RENDER_WORKERS)
+
+
+def enabled():
+    return RENDER_BACKEND == 'processes'
+
+
+def shutdown():
+    _pool.shutdown()
+
+
+def _render_in_worker(job):
+    # Runs in a worker process: decode any new layers into their shared buffers, then composite and encode.
+    # Returns (bytes, mime type, indexes of layers decoded here, {index: error} for layers that failed,
+    # {stage: seconds} so the server can report the timings).
+    timings = metrics.start_request()
+    layers, decoded, failed = [], [], {}
+    for index, item in enumerate(job['layers']):
+        width, height = item['size']
+        shape = (height, width, 4)
+        if item['content'] is None:
+            pixels = shared_pixels.attach(item['path'], shape)
+        else:
+            try:
+                pixels = shared_pixels.attach(item['path'], shape, writable=True)
+                with metrics.stage('decode'):
+                    pixels[...] = layer_cache.decode(item['content'], item['size'])
+                decoded.append(index)
+            except Exception as e:
+                failed[index] = str(e)
+                if index == 0:
+                    return None, None, decoded, failed, timings['stages']  # No base image, nothing to draw on
+                continue
+        layers.append((pixels, item['position'], item['coverage']))
+
+    options, scale = job['options'], job['scale']
+    with metrics.stage('composite'):
+        canvas = compositor.composite(layers, job['canvas_size'], background=render.WHITE)
+    render.draw_text(canvas, options, scale, job['fonts'])
+    body, mime_type = encoder.encode(canvas, options['format'], options['encode'])
+    return body, mime_type, decoded, failed, timings['stages']
+
+
+def render_request(data):
+    """Render one /combine-images payload on the worker pool; returns (bytes, mime type).
+
+    Fetching and planning stay on this process's I/O threads. Workers get the
+    layers as shared-memory buffers (or the compressed bytes plus an empty
+    shared buffer to decode into, the first time a layer is used at a size),
+    so no pixel data is pickled in either direction.
+    """
+    options = render.parse_request(data)
+    font_futures = render.start_font_fetch(options)
+    layers = layer_cache.get_layers(options['urls'])
+    fonts = render.fetch_fonts(options, font_futures)
+
+    reuse_shared = True
+    while True:
+        canvas_size, scale, plan = render.plan_stack(options, layers)
+        # A template's static layers go to the worker as one precomposited buffer
+        prefix = render.template_prefix(options, layers, plan) if reuse_shared else None
+        if prefix is not None and prefix[3] is None:
+            prefix = None  # Too big to keep in a shared buffer
+        entries, items = plan, []
+        if prefix:
+            entries = [None] + plan[prefix[0]:]
+            items.append({'size': canvas_size, 'position': (0, 0), 'path': prefix[3], 'content': None,
+                          'coverage': compositor.Coverage.solid((canvas_size[1], canvas_size[0]))})
+        for _, layer, size, position in entries[len(items):]:
+            path = layer.shared(size) if reuse_shared else None
+            # Already decoded here, so its coverage is known (or cheap to measure) and travels with it
+            item = {'size': size, 'position': position, 'path': path, 'content': None,
+                    'coverage': layer.coverage(size) if path else None}
+            if path is None:
+                item['path'] = shared_pixels.create((size[1], size[0], 4))
+                item['content'] = layer.path or layer.content  # Workers map local assets themselves
+            items.append(item)
+
+        job = {'layers': items, 'canvas_size': canvas_size, 'scale': scale,
+               'options': options, 'fonts': fonts}
+        decoded, failed = [], {}
+        try:
+            body, mime_type, decoded, failed, stages = _pool.run(_render_in_worker, job)
+            for name, seconds in stages.items():
+                metrics.record(name, seconds)
+        except FileNotFoundError:
+            # A cached buffer was evicted while the job waited in the queue; decode everything again
+            if not reuse_shared:
+                raise
+            reuse_shared = False
+            continue
+        finally:
+            # Keep what the worker decoded and free the buffers that went unused
+            for index, item in enumerate(items):
+                if item['content'] is None:
+                    continue
+                layer, size = entries[index][1], entries[index][2]
+                if index in decoded:
+                    layer.adopt_shared(size, item['path'])
+                    if not layer_cache.is_cached(layer):
+                        layer.release()
+                else:
+                    shared_pixels.remove(item['path'])
+
+        # Remember decode failures so later requests skip those layers (or pick another base)
+        for index, error in failed.items():
+            print(f"Error decoding image from {entries[index][1].url}: {error}")
+            entries[index][1].error = ValueError(error)
+        if 0 in failed:
+            continue  # The base didn't decode; plan again so the next image becomes the base, like build_stack()
+        render.count_skipped(options, layers)
+        print(f"Final image encoded as {mime_type}, {len(body)} bytes")
+        return body, mime_type
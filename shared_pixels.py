@@ -0,0 +1,41 @@
+import atexit
+import glob
+import os
+import tempfile
+import uuid
+
+import numpy as np
+
+# Pixel buffers shared with worker processes live as files in a RAM-backed directory,
+# so every process can map the same memory without copying or pickling it
+SHARED_DIR = os.environ.get('RENDER_SHARED_DIR') or ('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+
+_PREFIX = f'image-combiner-{os.getpid()}-'
+
+
+def create(shape):
+    # Make a new zero-filled shared buffer big enough for a uint8 array of this shape; returns its path
+    path = os.path.join(SHARED_DIR, _PREFIX + uuid.uuid4().hex)
+    with open(path, 'wb') as f:
+        f.truncate(int(np.prod(shape)))
+    return path
+
+
+def attach(path, shape, writable=False):
+    # Map a shared buffer as a uint8 array without copying it
+    return np.memmap(path, dtype=np.uint8, mode='r+' if writable else 'r', shape=tuple(shape))
+
+
+def remove(path):
+    # Drop the name; processes that still have it mapped keep their view until they let go
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+@atexit.register
+def _remove_all():
+    # Only the process that created the buffers cleans them up
+    for path in glob.glob(os.path.join(SHARED_DIR, _PREFIX + '*')):
+        remove(path)
@@ -0,0 +1,44 @@
+"""Single-flight: concurrent calls for the same key share one execution.
+
+The first caller for a key runs the work; callers that arrive while it is
+in flight wait for it and get the same result (or the same exception).
+Nothing is remembered afterwards; caching is left to the caller.
+"""
+import threading
+from concurrent.futures import Future
+
+import metrics
+
+
+class Group:
+    def __init__(self, kind):
+        self.kind = kind  # Label for the coalesced_total metric, e.g. 'layer'
+        self._calls = {}  # key -> Future of the call in flight
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args):
+        # Return fn(*args), or the result of the identical call already in flight for key
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+        if not leader:
+            metrics.COALESCED.inc(kind=self.kind)
+            return call.result()
+
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
@@ -0,0 +1,215 @@
+"""Registered templates: named layer stacks whose static part is composited ahead of time.
+
+A template is a /combine-images payload registered under an id. Its
+"images" are the static layers; a request that sends "template_id" adds its
+own "images" on top, and its other fields override the template's (see
+expand()). The static layers are composited once per canvas size and kept
+here, so each request only blends the layers that change.
+
+Templates live in memory; set TEMPLATES_DIR to keep them as JSON files
+that every worker process (and restarts) can see. gunicorn.conf.py sets up
+a directory for the server's lifetime when none is given, since a
+template registered through one worker must be usable from all of them.
+"""
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import shared_pixels
+
+TEMPLATES_DIR = os.environ.get('TEMPLATES_DIR')  # Optional shared store of <id>.json files
+TEMPLATE_CACHE_MAX_BYTES = int(os.environ.get('TEMPLATE_CACHE_MAX_BYTES', 256 * 1024 * 1024))  # Precomposited canvases
+
+_ID_PATTERN = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+
+_templates = {}  # template_id -> (template, mtime of its file or None)
+_prefixes = OrderedDict()  # key -> (pixels, shared buffer path), least recently used first
+_prefixes_bytes = 0
+_lock = threading.Lock()
+
+stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+class TemplateError(Exception):
+    pass
+
+
+def _path(template_id):
+    return os.path.join(TEMPLATES_DIR, f'{template_id}.json')
+
+
+def validate(template_id, template):
+    # Raise TemplateError if the id or the template's shape is unusable
+    if not isinstance(template_id, str) or not _ID_PATTERN.match(template_id):
+        raise TemplateError('Template ids are 1-64 letters, digits, ".", "_" or "-"')
+    if not isinstance(template, dict):
+        raise TemplateError('A template must be a JSON object')
+    if not isinstance(template.get('images'), list) or not template['images']:
+        raise TemplateError('A template needs at least one image')
+    if 'template_id' in template or 'pages' in template:
+        raise TemplateError('A template cannot use another template or have pages')
+    if not isinstance(template.get('text_blocks', []), list):
+        raise TemplateError("'text_blocks' must be a list of JSON objects")
+
+
+def register(template_id, template):
+    # Add or replace a template; precomposited canvases of an older version are dropped
+    validate(template_id, template)
+    mtime = None
+    if TEMPLATES_DIR:
+        os.makedirs(TEMPLATES_DIR, exist_ok=True)
+        # Unique to this process and thread, so concurrent registrations never share a temporary file
+        temp = _path(template_id) + f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(temp, 'w') as f:
+                json.dump(template, f)
+            os.replace(temp, _path(template_id))
+        except OSError:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            raise
+        mtime = os.stat(_path(template_id)).st_mtime
+    with _lock:
+        _templates[template_id] = (template, mtime)
+    _drop_prefixes(template_id)
+
+
+def get(template_id):
+    # The template registered under an id, or None
+    with _lock:
+        template, mtime = _templates.get(template_id, (None, None))
+    if not TEMPLATES_DIR or not isinstance(template_id, str) or not _ID_PATTERN.match(template_id):
+        return template
+
+    # Another process may have registered, replaced or removed it
+    try:
+        current = os.stat(_path(template_id)).st_mtime
+    except OSError:
+        if template is not None:
+            remove(template_id)
+        return None
+    if current == mtime:
+        return template
+    try:
+        with open(_path(template_id)) as f:
+            template = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error reading template {template_id}: {e}")
+        return None
+    with _lock:
+        _templates[template_id] = (template, current)
+    _drop_prefixes(template_id)
+    return template
+
+
+def remove(template_id):
+    # Forget a template; returns whether it existed
+    with _lock:
+        existed = _templates.pop(template_id, None) is not None
+    if TEMPLATES_DIR and _ID_PATTERN.match(template_id):
+        try:
+            os.remove(_path(template_id))
+            existed = True
+        except OSError:
+            pass
+    _drop_prefixes(template_id)
+    return existed
+
+
+def list_ids():
+    if not TEMPLATES_DIR:
+        return sorted(_templates)
+    # The directory is the source of truth; other processes may have added or removed templates
+    if not os.path.isdir(TEMPLATES_DIR):
+        return []
+    return sorted(name[:-len('.json')] for name in os.listdir(TEMPLATES_DIR) if name.endswith('.json'))
+
+
+def expand(data):
+    """Merge a request that names a template into a complete payload.
+
+    The template's fields are defaults; the request's "images" go on top of
+    the template's. Text blocks are merged by position (a request block
+    overrides the fields of the template block at the same index, extra
+    ones are added), and a plain "text" fills in the template's first block.
+    Returns (payload, number of static layers). Raises KeyError for an
+    unknown id.
+    """
+    template = get(data.get('template_id'))
+    if template is None:
+        raise KeyError(data.get('template_id'))
+    payload = dict(template)
+    payload.update({name: value for name, value in data.items() if name not in ('template_id', 'images', 'text_blocks')})
+    payload['images'] = list(template['images']) + list(data.get('images') or [])
+
+    blocks = [dict(block) for block in template.get('text_blocks', [])]
+    requested = data.get('text_blocks')
+    if requested is None and 'text' in data and blocks:
+        requested = [{'text': data['text']}]
+    if isinstance(requested, list):
+        for index, block in enumerate(requested):
+            if index < len(blocks) and isinstance(block, dict):
+                blocks[index].update(block)
+            else:
+                blocks.append(block)
+    if blocks or requested is not None:
+        payload['text_blocks'] = blocks
+    return payload, len(template['images'])
+
+
+def get_prefix(key):
+    # The precomposited pixels and their shared buffer path for a key, or None
+    with _lock:
+        hit = _prefixes.get(key)
+        if hit is not None:
+            _prefixes.move_to_end(key)
+            stats['hits'] += 1
+        else:
+            stats['misses'] += 1
+    return hit
+
+
+def put_prefix(key, pixels):
+    # Keep a precomposited canvas in a shared buffer (so worker processes can map it); returns (pixels, path)
+    global _prefixes_bytes
+    if pixels.nbytes > TEMPLATE_CACHE_MAX_BYTES:
+        return pixels, None
+    path = shared_pixels.create(pixels.shape)
+    shared_pixels.attach(path, pixels.shape, writable=True)[...] = pixels
+    stored = (shared_pixels.attach(path, pixels.shape), path)
+    evicted = []
+    with _lock:
+        replaced = _prefixes.pop(key, None)
+        if replaced is not None:
+            evicted.append(replaced)
+            _prefixes_bytes -= replaced[0].nbytes
+        _prefixes[key] = stored
+        _prefixes_bytes += pixels.nbytes
+        while _prefixes_bytes > TEMPLATE_CACHE_MAX_BYTES:
+            _, dropped = _prefixes.popitem(last=False)
+            _prefixes_bytes -= dropped[0].nbytes
+            stats['evictions'] += 1
+            evicted.append(dropped)
+    for _, dropped_path in evicted:
+        shared_pixels.remove(dropped_path)
+    return stored
+
+
+def _drop_prefixes(template_id):
+    global _prefixes_bytes
+    with _lock:
+        keys = [key for key in _prefixes if key[0] == template_id]
+        dropped = [_prefixes.pop(key) for key in keys]
+        _prefixes_bytes -= sum(pixels.nbytes for pixels, _ in dropped)
+    for _, path in dropped:
+        shared_pixels.remove(path)
+
+
+def get_stats():
+    with _lock:
+        return dict(stats, templates=len(_templates), prefixes=len(_prefixes), bytes=_prefixes_bytes,
+                    max_bytes=TEMPLATE_CACHE_MAX_BYTES)
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+# The modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_canvas(seed, size=(64, 48)):
+    # An opaque RGBA canvas with smooth gradients and some noise, like a composited render
+    width, height = size
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = np.empty((height, width, 4), dtype=np.uint8)
+    pixels[..., 0] = (x * 255 // max(1, width - 1) + seed * 40) % 256
+    pixels[..., 1] = (y * 255 // max(1, height - 1) + seed * 90) % 256
+    pixels[..., 2] = ((x + y) * 2 + rng.integers(0, 16, (height, width))) % 256
+    pixels[..., 3] = 255
+    return Image.fromarray(pixels, 'RGBA')
+
+
+@pytest.fixture
+def canvases():
+    return [make_canvas(seed) for seed in range(3)]
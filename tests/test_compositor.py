@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+import compositor
+
+
+def _random_layer(rng, width, height):
+    # RGBA pixels mixing transparent, opaque and partly transparent rows, columns and pixels
+    pixels = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+    alpha = pixels[..., 3]
+    alpha[rng.random((height, width)) < 0.3] = 0
+    alpha[rng.random((height, width)) < 0.3] = 255
+    alpha[rng.random(height) < 0.2] = 255  # Opaque rows take the copy path with Coverage
+    alpha[rng.random(height) < 0.2] = 0  # Transparent rows are skipped with Coverage
+    if width > 2:
+        alpha[:, :rng.integers(0, width // 2)] = 0  # Coverage clips to the inked columns
+    return pixels
+
+
+def _reference(layers, size, background, start=None):
+    # What composite() promises: alpha_composite once per layer, each padded to the canvas
+    canvas = Image.new('RGBA', size, background) if start is None else Image.fromarray(start, 'RGBA')
+    for pixels, (x, y) in layers:
+        padded = Image.new('RGBA', size, (0, 0, 0, 0))
+        padded.paste(Image.fromarray(pixels, 'RGBA'), (x, y))
+        canvas = Image.alpha_composite(canvas, padded)
+    return np.asarray(canvas)
+
+
+def _random_case(seed):
+    rng = np.random.default_rng(seed)
+    size = (int(rng.integers(1, 90)), int(rng.integers(1, 90)))  # Often taller than one strip
+    layers = []
+    for _ in range(rng.integers(1, 5)):
+        width, height = int(rng.integers(1, 120)), int(rng.integers(1, 120))
+        # Offsets from well off the top-left to past the bottom-right: full, partial, negative and no overlap
+        x = int(rng.integers(-width - 5, size[0] + 5))
+        y = int(rng.integers(-height - 5, size[1] + 5))
+        layers.append((_random_layer(rng, width, height), (x, y)))
+    return size, layers
+
+
+@pytest.mark.parametrize('background', [(255, 255, 255, 255), (30, 60, 90, 255), (30, 60, 90, 128), (0, 0, 0, 0)])
+@pytest.mark.parametrize('with_coverage', [False, True])
+@pytest.mark.parametrize('seed', range(25))
+def test_composite_matches_alpha_composite(seed, with_coverage, background):
+    size, layers = _random_case(seed)
+    arguments = [(pixels, offset, compositor.Coverage.of(pixels)) if with_coverage else (pixels, offset)
+                 for pixels, offset in layers]
+    result = compositor.composite_pixels(arguments, size, background)
+    assert np.array_equal(result, _reference(layers, size, background))
+
+
+@pytest.mark.parametrize('background', [(255, 255, 255, 255), (30, 60, 90, 128)])
+@pytest.mark.parametrize('seed', range(10))
+def test_composite_from_start_matches_alpha_composite(seed, background):
+    size, layers = _random_case(100 + seed)
+    start = compositor.composite_pixels(layers[:1], size, background)
+    result = compositor.composite_pixels(layers[1:], size, background, start=start)
+    assert np.array_equal(result, _reference(layers[1:], size, background, start=start))
+    assert np.array_equal(result, _reference(layers, size, background))
+
+
+def test_composite_accepts_images():
+    rng = np.random.default_rng(7)
+    pixels = _random_layer(rng, 40, 50)
+    image = compositor.composite([Image.fromarray(pixels, 'RGBA')], (40, 50), (10, 20, 30, 255))
+    assert np.array_equal(np.asarray(image), _reference([(pixels, (0, 0))], (40, 50), (10, 20, 30, 255)))
@@ -0,0 +1,67 @@
+import threading
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import encoder
+from conftest import make_canvas
+
+
+def _pixels(body):
+    return np.asarray(Image.open(BytesIO(body)).convert('RGB'))
+
+
+@pytest.mark.parametrize('size', [(1, 1), (3, 5), (9, 17), (64, 33)])
+@pytest.mark.parametrize('options', [{}, {'quantize': 16}, {'compress_level': 1}])
+def test_interlaced_png_has_the_same_pixels(size, options):
+    canvas = make_canvas(1, size)
+    body, mime_type = encoder.encode(canvas, 'png', dict(options, interlace=True))
+    plain, _ = encoder.encode(canvas, 'png', options)
+    assert mime_type == 'image/png'
+    assert Image.open(BytesIO(body)).info.get('interlace') == 1
+    assert np.array_equal(_pixels(body), _pixels(plain))
+
+
+@pytest.mark.parametrize('output_format, options', [
+    ('png', {}), ('png', {'interlace': True}), ('jpeg', {}), ('jpeg', {'progressive': True}), ('gif', {}),
+])
+def test_stream_matches_encode(output_format, options):
+    canvas = make_canvas(2, (300, 200))
+    stream = encoder.Stream(canvas, output_format, options)
+    expected, mime_type = encoder.encode(canvas, output_format, options)
+    assert stream.mime_type == mime_type
+    assert b''.join(stream) == expected
+    assert stream.result() == expected  # Every reader gets the whole output
+
+
+def test_stream_readers_started_at_once_all_get_everything():
+    canvas = make_canvas(3, (400, 300))
+    stream = encoder.Stream(canvas, 'png', {'interlace': True})
+    results = [None] * 4
+
+    def read(index):
+        results[index] = b''.join(stream)
+    readers = [threading.Thread(target=read, args=(index,)) for index in range(len(results))]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    assert results == [stream.result()] * len(results)
+
+
+def test_stream_done_callbacks_and_errors():
+    done = []
+    stream = encoder.Stream(None, 'png')  # Nothing to encode, so the encoder fails
+    stream.add_done_callback(done.append)
+    with pytest.raises(AttributeError):
+        b''.join(stream)
+    assert stream.error is not None
+    stream.add_done_callback(done.append)  # Already finished: called right away
+    assert done == [stream, stream]
+
+
+def test_formats_that_cannot_stream_are_refused():
+    with pytest.raises(ValueError):
+        encoder.Stream(make_canvas(0), 'pdf')
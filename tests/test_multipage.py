@@ -0,0 +1,75 @@
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image, ImageSequence
+
+import encoder
+import multipage
+import render
+
+pypdf = pytest.importorskip('pypdf')
+
+
+def _pixels(image):
+    return np.asarray(image.convert('RGB'))
+
+
+def _write(output_format, canvases, durations=None, options=None, loop=0):
+    durations = durations or [100] * len(canvases)
+    return b''.join(multipage.stream(output_format, zip(canvases, durations), options, loop))
+
+
+def test_pdf_pages_embed_the_encoded_jpegs(canvases):
+    reader = pypdf.PdfReader(BytesIO(_write('pdf', canvases, options={'quality': 90})), strict=True)
+    assert len(reader.pages) == len(canvases)
+    for page, canvas in zip(reader.pages, canvases):
+        assert (float(page.mediabox.width), float(page.mediabox.height)) == canvas.size
+        image = page['/Resources']['/XObject']['/Im0'].get_object()
+        assert (image['/Width'], image['/Height'], image['/Filter']) == (*canvas.size, '/DCTDecode')
+        expected, _ = encoder.encode(canvas, 'jpeg', {'quality': 90})
+        assert image.get_data() == expected
+        # And it decodes to the page, give or take JPEG's loss
+        decoded = _pixels(Image.open(BytesIO(image.get_data()))).astype(int)
+        assert np.abs(decoded - _pixels(canvas)).mean() < 8
+
+
+def test_gif_frames_match_single_frame_output(canvases):
+    image = Image.open(BytesIO(_write('gif', canvases, durations=[100, 250, 40], loop=3)))
+    assert image.n_frames == len(canvases)
+    assert image.info['loop'] == 3
+    for frame, canvas, duration in zip(ImageSequence.Iterator(image), canvases, [100, 250, 40]):
+        assert frame.info['duration'] == duration
+        expected, _ = encoder.encode(canvas, 'gif', {})
+        assert np.array_equal(_pixels(frame), _pixels(Image.open(BytesIO(expected))))
+
+
+def test_webp_frames_match_the_canvases(canvases):
+    if not encoder.available('webp'):
+        pytest.skip('WebP is not available')
+    image = Image.open(BytesIO(_write('webp', canvases, durations=[100, 250, 40], options={'lossless': True}, loop=2)))
+    assert image.n_frames == len(canvases)
+    assert image.info['loop'] == 2
+    for index, (canvas, duration) in enumerate(zip(canvases, [100, 250, 40])):
+        image.seek(index)
+        image.load()  # The frame's duration is only known once it is decoded
+        assert image.info['duration'] == duration
+        assert np.array_equal(_pixels(image), _pixels(canvas))
+
+
+def test_frames_of_another_size_are_resized(canvases):
+    canvases[1] = canvases[1].resize((32, 24))
+    image = Image.open(BytesIO(_write('gif', canvases)))
+    image.seek(1)
+    assert image.size == canvases[0].size
+
+
+@pytest.mark.parametrize('output_format, longest', [('gif', 655350), ('webp', 0xffffff)])
+def test_durations_the_format_cannot_store_are_rejected(output_format, longest):
+    def payload(duration):
+        return {'format': output_format, 'duration': duration, 'pages': [{'images': ['http://example.com/a.png']}]}
+
+    render.parse_pages(payload(longest))
+    with pytest.raises(render.RenderError) as error:
+        render.parse_pages(payload(longest + 1))
+    assert error.value.status == 400
@@ -0,0 +1,237 @@
+"""Text blocks: wrapping to a box, alignment, shrink-to-fit and cached masks.
+
+A block is laid out once into an "L" coverage mask, which is cached by
+everything that affects its shape (font, size, text and layout settings),
+so a caption that repeats across requests is pasted instead of rasterized
+again. Pasting the colour through the mask gives the same pixels as
+ImageDraw.text would.
+"""
+import math
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+import font_cache
+
+TEXT_MASK_CACHE_MAX_BYTES = int(os.environ.get('TEXT_MASK_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+
+ALIGNS = ('left', 'center', 'right')
+VALIGNS = ('top', 'middle', 'bottom')
+
+_masks = OrderedDict()  # layout key -> (mask, (x, y) of the mask relative to the block position)
+_masks_bytes = 0
+_lock = threading.Lock()
+
+stats = {'hits': 0, 'misses': 0}
+
+
+class FontError(Exception):
+    # A block's font couldn't be fetched or parsed
+    pass
+
+
+def parse_block(entry, defaults):
+    """Normalise one text block; raises ValueError describing the first bad field.
+
+    Fields not given in the block come from defaults (the request's top-level
+    text settings).
+    """
+    def get(name, fallback):
+        return entry.get(name, defaults.get(name, fallback))
+
+    block = {
+        'text': str(get('text', '')),
+        'font_url': get('font_url', None),  # None draws with Pillow's built-in bitmap font
+        'font_size': get('font_size', 180),
+        'position': get('position', defaults.get('text_position', (100, 100))),  # Top-left of the block
+        'box': get('box', None),  # (width, height) to wrap and align in; None for one line per "\n"
+        'align': get('align', 'left'),
+        'valign': get('valign', 'top'),  # Needs a box
+        'wrap': get('wrap', True),  # Break lines to the box width
+        'fit': get('fit', False),  # Shrink the font (down to min_font_size) until the text fits the box
+        'min_font_size': get('min_font_size', 8),
+        'line_spacing': get('line_spacing', 4),  # Extra pixels between lines, like ImageDraw's spacing
+        'color': get('color', 'black'),
+    }
+    for name in ('font_size', 'min_font_size'):
+        if not isinstance(block[name], (int, float)) or isinstance(block[name], bool) or block[name] <= 0:
+            raise ValueError(f"'{name}' must be a positive number of pixels")
+    position = block['position']
+    if (not isinstance(position, (list, tuple)) or len(position) != 2
+            or not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in position)):
+        raise ValueError("'position' must be [x, y] in pixels")
+    block['position'] = tuple(block['position'])
+    if block['box'] is not None:
+        box = block['box']
+        if (not isinstance(box, (list, tuple)) or len(box) != 2
+                or not all(isinstance(value, int) and not isinstance(value, bool) and value > 0 for value in box)):
+            raise ValueError("'box' must be [width, height] in whole pixels")
+        block['box'] = tuple(box)
+    if block['align'] not in ALIGNS:
+        raise ValueError(f"'align' must be one of {', '.join(ALIGNS)}")
+    if block['valign'] not in VALIGNS:
+        raise ValueError(f"'valign' must be one of {', '.join(VALIGNS)}")
+    if not isinstance(block['line_spacing'], int) or isinstance(block['line_spacing'], bool):
+        raise ValueError("'line_spacing' must be a whole number of pixels")
+    block['wrap'], block['fit'] = bool(block['wrap']), bool(block['fit'])
+    color = block['color']
+    if isinstance(color, str):
+        try:
+            block['color'] = ImageColor.getrgb(color)
+        except ValueError:
+            raise ValueError(f"Unknown text color {color!r}")
+    elif (isinstance(color, (list, tuple)) and len(color) in (3, 4)
+            and all(isinstance(value, int) and not isinstance(value, bool) and 0 <= value <= 255 for value in color)):
+        block['color'] = tuple(color)
+    else:
+        raise ValueError("'color' must be a color name, '#rrggbb', or [r, g, b] / [r, g, b, a] from 0 to 255")
+    return block
+
+
+def _font(font_url, size, fonts):
+    if not font_url:
+        return ImageFont.load_default()
+    try:
+        return font_cache.get_font(font_url, size, fonts.get(font_url))
+    except OSError as e:
+        raise FontError(f'{font_url}: {e}')
+
+
+def _wrap(font, text, width):
+    # Greedy word wrap of every paragraph to width pixels; words wider than a line are split by character
+    lines = []
+    for paragraph in text.split('\n'):
+        line = ''
+        for word in paragraph.split(' '):
+            candidate = f'{line} {word}' if line else word
+            if font.getlength(candidate) <= width:
+                line = candidate
+                continue
+            if line:
+                lines.append(line)
+            line = ''
+            for char in word:
+                if line and font.getlength(line + char) > width:
+                    lines.append(line)
+                    line = ''
+                line += char
+        lines.append(line)
+    return lines
+
+
+def _layout(font, block, box, spacing):
+    # Lines and their (x, y) origins (ascender anchor) relative to the block position, plus the ink bounds
+    if box is not None and block['wrap']:
+        lines = _wrap(font, block['text'], box[0])
+    else:
+        lines = block['text'].split('\n')
+    line_height = font.getbbox('A')[3] + spacing
+    widths = [font.getlength(line) for line in lines]
+    width = box[0] if box is not None else max(widths)
+
+    placed, bounds = [], None
+    for index, (line, line_width) in enumerate(zip(lines, widths)):
+        x = 0
+        if block['align'] == 'center':
+            x = round((width - line_width) / 2)
+        elif block['align'] == 'right':
+            x = round(width - line_width)
+        y = index * line_height
+        placed.append((line, (x, y)))
+        left, top, right, bottom = font.getbbox(line)
+        ink = (x + left, y + top, x + right, y + bottom)
+        bounds = ink if bounds is None else (min(bounds[0], ink[0]), min(bounds[1], ink[1]),
+                                             max(bounds[2], ink[2]), max(bounds[3], ink[3]))
+
+    if box is not None and block['valign'] != 'top':
+        shift = box[1] - bounds[3]
+        if block['valign'] == 'middle':
+            shift = round((box[1] - bounds[1] - bounds[3]) / 2)
+        placed = [(line, (x, y + shift)) for line, (x, y) in placed]
+        bounds = (bounds[0], bounds[1] + shift, bounds[2], bounds[3] + shift)
+    return placed, bounds
+
+
+def _fits(bounds, box):
+    return bounds[2] - min(bounds[0], 0) <= box[0] and bounds[3] - min(bounds[1], 0) <= box[1]
+
+
+def _render(block, size, box, spacing, min_size, fonts, fraction=(0.0, 0.0)):
+    # Lay the block out (shrinking the font if asked to) and draw it into a coverage mask, shifted by the
+    # fractional part of the block's position
+    font = _font(block['font_url'], size, fonts)
+    placed, bounds = _layout(font, block, box, spacing)
+    if block['fit'] and box is not None and block['font_url'] and not _fits(bounds, box):
+        # Binary search for the largest size that fits; falls back to min_size if nothing does
+        low, high = min_size, size - 1
+        best = None
+        while low <= high:
+            middle = (low + high) // 2
+            candidate = _font(block['font_url'], middle, fonts)
+            layout = _layout(candidate, block, box, spacing)
+            if _fits(layout[1], box):
+                best, low = (candidate, layout), middle + 1
+            else:
+                high = middle - 1
+        font, (placed, bounds) = best or (_font(block['font_url'], min_size, fonts),
+                                          _layout(_font(block['font_url'], min_size, fonts), block, box, spacing))
+
+    left, top, right, bottom = bounds
+    fx, fy = fraction
+    # Ink shifted by a fraction of a pixel can reach one pixel further
+    mask = Image.new('L', (max(1, right - left + (fx > 0)), max(1, bottom - top + (fy > 0))), 0)
+    draw = ImageDraw.Draw(mask)
+    for line, (x, y) in placed:
+        if line:
+            draw.text((x - left + fx, y - top + fy), line, font=font, fill=255)
+    return mask, (left, top)
+
+
+def draw(canvas, block, scale, fonts):
+    """Draw a parsed text block onto the canvas.
+
+    scale shrinks the block along with the image when a smaller output was
+    requested. fonts is {font_url: bytes} for fonts downloaded elsewhere
+    (e.g. in another process); others come from font_cache. Raises
+    FontError when a font can't be fetched or parsed.
+    """
+    global _masks_bytes
+    if not block['text']:
+        return
+    size = max(1, round(block['font_size'] * scale))
+    min_size = min(size, max(1, round(block['min_font_size'] * scale)))
+    box = tuple(max(1, round(value * scale)) for value in block['box']) if block['box'] else None
+    spacing = round(block['line_spacing'] * scale)
+    # Draw at a fractional position the way ImageDraw.text() would on the canvas: the whole pixels
+    # place the mask and the fraction goes into it, so it is part of the key
+    x, y = block['position'][0] * scale, block['position'][1] * scale
+    fraction = (x - math.floor(x), y - math.floor(y))
+    key = (block['font_url'], size, block['text'], box, block['align'], block['valign'],
+           block['wrap'], block['fit'], min_size, spacing, fraction)
+
+    with _lock:
+        cached = _masks.get(key)
+        if cached is not None:
+            _masks.move_to_end(key)
+            stats['hits'] += 1
+    if cached is None:
+        cached = _render(block, size, box, spacing, min_size, fonts, fraction)
+        mask_bytes = cached[0].size[0] * cached[0].size[1]
+        with _lock:
+            stats['misses'] += 1
+            if key not in _masks and mask_bytes <= TEXT_MASK_CACHE_MAX_BYTES:
+                _masks[key] = cached
+                _masks_bytes += mask_bytes
+                while _masks_bytes > TEXT_MASK_CACHE_MAX_BYTES:
+                    _, (evicted, _) = _masks.popitem(last=False)
+                    _masks_bytes -= evicted.size[0] * evicted.size[1]
+
+    mask, (left, top) = cached
+    canvas.paste(block['color'], (math.floor(x) + left, math.floor(y) + top), mask)
+
+
+def get_stats():
+    with _lock:
+        return dict(stats, entries=len(_masks), bytes=_masks_bytes, max_bytes=TEXT_MASK_CACHE_MAX_BYTES)
@@ -0,0 +1,64 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+def default_workers():
+    # This server process's share of the CPUs: gunicorn's web workers (WEB_WORKERS, set by gunicorn.conf.py)
+    # each start their own pools, so they split the box rather than each sizing a pool for all of it
+    return max(1, (os.cpu_count() or 2) // max(1, int(os.environ.get('WEB_WORKERS', 1))))
+
+
+class WorkerPool:
+    """A lazily started pool of worker processes that replaces itself when a worker dies.
+
+    Workers are spawned rather than forked so they don't inherit the server's
+    threads. A worker that dies (e.g. killed for memory) breaks the whole
+    executor; the next call shuts it down, starts a fresh one and tries once
+    more.
+    """
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _current(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _replace(self, broken):
+        # Only the first caller to notice replaces the pool; the others find the new one
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+        broken.shutdown(wait=False)
+
+    def submit(self, fn, *args):
+        # Start fn(*args) in a worker; returns its Future
+        executor = self._current()
+        try:
+            return executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self._replace(executor)
+            return self._current().submit(fn, *args)
+
+    def run(self, fn, *args):
+        # fn(*args) in a worker, waiting for the result; retried once if a worker dies while it runs
+        executor = self._current()
+        try:
+            return executor.submit(fn, *args).result()
+        except BrokenProcessPool:
+            self._replace(executor)
+            return self._current().submit(fn, *args).result()
+
+    def shutdown(self):
+        # Let queued and running work finish, then stop the workers
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)